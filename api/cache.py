@@ -0,0 +1,117 @@
+"""Async-safe in-process caching helpers."""
+
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Callable, Dict, Hashable
+from cachetools import TTLCache
+
+
+def content_hash(namespace: str, text: str) -> bytes:
+    """
+    Hash text into a cache key scoped to a namespace (e.g. a model name).
+
+    The text length is included as a fixed-width prefix so that distinct
+    (namespace, text) pairs can never serialize to the same bytes. A 16-byte
+    BLAKE2b digest is faster than SHA-256 on long prompts and plenty to keep
+    keys of an in-process cache from colliding.
+    """
+    return hashlib.blake2b(f"{namespace}\0{len(text):08d}\0{text}".encode(), digest_size=16).digest()
+
+
+def _start(compute: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+    """Run compute() in a task of its own, shared by every caller waiting on it.
+
+    Callers await the task through asyncio.shield, so cancelling one caller
+    (e.g. a disconnected client) never cancels the work the others wait for;
+    it is only cancelled when no caller is left waiting.
+    """
+    task = asyncio.ensure_future(compute())
+    # Mark a failure as retrieved even if every caller was cancelled meanwhile
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return task
+
+
+async def _await_shared(task: asyncio.Future, waiters: Dict[asyncio.Future, int]) -> Any:
+    """Wait for a shared task, cancelling it once every caller waiting on it is gone."""
+    waiters[task] = waiters.get(task, 0) + 1
+    try:
+        return await asyncio.shield(task)
+    finally:
+        waiters[task] -= 1
+        if not waiters[task]:
+            del waiters[task]
+            # Nobody wants the result any more, e.g. an unused speculative call
+            if not task.done():
+                task.cancel()
+
+
+def _failed(task: asyncio.Future) -> bool:
+    """Return whether a finished task was cancelled or raised."""
+    return task.cancelled() or task.exception() is not None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key into a single computation.
+
+    Unlike AsyncTTLCache nothing is retained: once the call finishes, the next
+    caller with the same key starts a fresh one.
+    """
+
+    def __init__(self):
+        """Initialize with no calls in flight."""
+        self._tasks: Dict[Hashable, asyncio.Future] = {}
+        self._waiters: Dict[asyncio.Future, int] = {}
+
+    async def do(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the result of compute(), sharing it with concurrent callers of key."""
+        task = self._tasks.get(key)
+        if task is None:
+            task = _start(compute)
+            self._tasks[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        return await _await_shared(task, self._waiters)
+
+    def _forget(self, key: Hashable, task: asyncio.Future) -> None:
+        """Drop a finished call so the next caller starts a fresh one."""
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+
+class AsyncTTLCache:
+    """
+    TTL cache for coroutine results with request coalescing.
+
+    The cache stores tasks rather than values, so concurrent misses on the
+    same key share a single upstream call instead of each firing their own.
+    Failed computations are not cached.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 86400):
+        """Initialize the cache with a maximum size and a TTL in seconds."""
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._waiters: Dict[asyncio.Future, int] = {}
+
+    async def get_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the cached value for key, calling compute() once on a miss."""
+        # No await between the lookup and the insert, so this is atomic on the event loop
+        task = self._cache.get(key)
+        if task is None:
+            task = _start(compute)
+            self._cache[key] = task
+            task.add_done_callback(lambda t: self._evict_failed(key, t))
+        return await _await_shared(task, self._waiters)
+
+    def has_value(self, key: Hashable) -> bool:
+        """Return whether key has a finished, successful computation cached."""
+        task = self._cache.get(key)
+        return task is not None and task.done() and not _failed(task)
+
+    def _evict_failed(self, key: Hashable, task: asyncio.Future) -> None:
+        """Drop a failed computation so the next caller retries it."""
+        if _failed(task) and self._cache.get(key) is task:
+            del self._cache[key]
+
+    def clear(self) -> None:
+        """Drop all cached entries."""
+        self._cache.clear()
@@ -1,36 +1,122 @@
 """Simple database service for Supabase integration."""
 
+import math
 import os
-from typing import List, Dict, Any
-from supabase import create_client, Client
-from pydantic import BaseModel
+from dataclasses import dataclass, field
+from typing import AsyncIterator, List, Dict, Any, Optional
+import httpx
+import orjson
+from supabase import AClient as AsyncClient, AClientOptions
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Fail fast on stuck connections instead of stalling the request handler
+_POSTGREST_TIMEOUT = httpx.Timeout(10.0, connect=2.0)
 
-class SimilarQuery(BaseModel):
-    """Model for similar query results with similarity scores."""
+
+async def _execute_with_retry(query):
+    """Execute a read-only PostgREST query, retrying transient network failures."""
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=1, max=8),
+        retry=retry_if_exception_type((httpx.TimeoutException, httpx.ConnectError)),
+        reraise=True
+    ):
+        with attempt:
+            return await query.execute()
+
+
+def normalize_embedding(embedding: List[float]) -> List[float]:
+    """Scale an embedding to unit length so cosine similarity is a plain dot product."""
+    norm = math.hypot(*embedding)
+    if not norm:
+        return list(embedding)
+    return [x / norm for x in embedding]
+
+
+def parse_embedding(value) -> Optional[List[float]]:
+    """Decode a vector column, which PostgREST returns as a '[x,y,...]' string."""
+    if value is None or isinstance(value, list):
+        return value
+    return orjson.loads(value)
+
+
+def _query_row(
+    user_id: str,
+    prompt: str,
+    response: str,
+    prompt_embedding: List[float],
+    response_embedding: List[float],
+    cached_query_id: str = None,
+    model_used: str = 'unknown',
+    tokens_used: int = 0,
+    response_time_ms: int = 0,
+    rating: int = None,
+    keywords: List[str] = None
+) -> Dict[str, Any]:
+    """Build a queries table row, leaving out optional fields that aren't set."""
+    query_data = {
+        'user_id': user_id,
+        'prompt': prompt,
+        'response': response,
+        'prompt_embedding': normalize_embedding(prompt_embedding),
+        'response_embedding': response_embedding,
+        'model_used': model_used,
+        'tokens_used': tokens_used,
+        'response_time_ms': response_time_ms
+    }
+
+    # Add cached_query_id if provided
+    if cached_query_id:
+        query_data['cached_query_id'] = cached_query_id
+
+    # Add rating if provided
+    if rating is not None:
+        query_data['rating'] = rating
+
+    # Add keywords if provided
+    if keywords is not None:
+        query_data['keywords'] = keywords
+
+    return query_data
+
+
+@dataclass(slots=True, frozen=True)
+class SimilarQuery:
+    """Similar query result with its similarity score.
+
+    A plain dataclass rather than a Pydantic model: rows come straight from
+    our own RPC, so per-field validation on every result adds nothing.
+    """
     id: str
     user_id: str
     prompt: str
     response: str
     similarity_score: float
-    keywords: List[str] = []
+    keywords: List[str] = field(default_factory=list)
+    # Only fetched by find_similar_queries when asked; None for rows stored without one
+    response_embedding: Optional[List[float]] = None
 
 
 class DatabaseService:
-    """Simple service for database operations with vector similarity search."""
+    """Simple service for database operations with vector similarity search.
+
+    Uses Supabase's async client so database round trips never block the
+    event loop serving other requests.
+    """
 
     def __init__(self):
         """Initialize database service."""
-        self.supabase: Client = create_client(
+        self.supabase: AsyncClient = AsyncClient(
             os.getenv("SUPABASE_URL"),
-            os.getenv("SUPABASE_API")  # Using your actual env var name
+            os.getenv("SUPABASE_API"),  # Using your actual env var name
+            options=AClientOptions(postgrest_client_timeout=_POSTGREST_TIMEOUT)
         )
 
-    def store_query(
+    async def store_query(
         self,
         user_id: str,
         prompt: str,
@@ -45,59 +131,125 @@ class DatabaseService:
         keywords: List[str] = None
     ) -> str:
         """Store a query with its embeddings and metadata in the database."""
-        query_data = {
-            'user_id': user_id,
-            'prompt': prompt,
-            'response': response,
-            'prompt_embedding': prompt_embedding,
-            'response_embedding': response_embedding,
-            'model_used': model_used,
-            'tokens_used': tokens_used,
-            'response_time_ms': response_time_ms
-        }
-
-        # Add cached_query_id if provided
-        if cached_query_id:
-            query_data['cached_query_id'] = cached_query_id
-
-        # Add rating if provided
-        if rating is not None:
-            query_data['rating'] = rating
+        query_data = _query_row(
+            user_id, prompt, response, prompt_embedding, response_embedding,
+            cached_query_id, model_used, tokens_used, response_time_ms, rating, keywords
+        )
+        result = await self.supabase.table('queries').insert(query_data).execute()
 
-        # Add keywords if provided
-        if keywords is not None:
-            query_data['keywords'] = keywords
+        return result.data[0]['id']
 
-        result = self.supabase.table('queries').insert(query_data).execute()
+    async def store_queries(self, queries: List[Dict[str, Any]], batch_size: int = 500) -> List[str]:
+        """Store many queries with one insert per batch instead of one per query.
 
-        return result.data[0]['id']
+        Each dict takes the keyword arguments of store_query. Returns the
+        stored query IDs in input order.
+        """
+        rows = [_query_row(**query) for query in queries]
+        query_ids: List[str] = []
+        for start in range(0, len(rows), batch_size):
+            # Fields a row leaves out get the column default, as with store_query
+            result = await self.supabase.table('queries').insert(
+                rows[start:start + batch_size], default_to_null=False
+            ).execute()
+            query_ids.extend(row['id'] for row in result.data)
+        return query_ids
 
-    def find_similar_queries(
+    async def find_similar_queries(
         self,
         prompt_embedding: List[float],
         similarity_threshold: float = 0.7,
-        max_results: int = 5
+        max_results: int = 5,
+        ef_search: Optional[int] = None,
+        include_response_embedding: bool = False
     ) -> List[SimilarQuery]:
-        """Find similar queries using vector similarity search."""
-        # Use Supabase's RPC function for vector similarity
-        result = self.supabase.rpc('match_queries', {
-            'query_embedding': prompt_embedding,
+        """Find similar queries using vector similarity search.
+
+        ef_search sets the HNSW candidate list size for this search (the
+        database default is 100); higher values trade latency for recall.
+        include_response_embedding also fetches each row's response
+        embedding, so a cache hit can reuse it without a second round trip.
+        """
+        params = {
+            'query_embedding': normalize_embedding(prompt_embedding),
             'match_threshold': similarity_threshold,
             'match_count': max_results
-        }).execute()
+        }
+        if ef_search is not None:
+            params['ef_search'] = ef_search
+        if include_response_embedding:
+            params['with_response_embedding'] = True
+
+        # Use Supabase's RPC function for vector similarity
+        result = await _execute_with_retry(self.supabase.rpc('match_queries', params))
 
         return [
             SimilarQuery(
-                id=row['id'],
-                user_id=row['user_id'],
-                prompt=row['prompt'],
-                response=row['response'],
-                similarity_score=row['similarity'],
-                keywords=row.get('keywords', [])
+                row['id'],
+                row['user_id'],
+                row['prompt'],
+                row['response'],
+                row['similarity'],
+                row.get('keywords') or [],
+                parse_embedding(row.get('response_embedding'))
             )
             for row in result.data
         ]
 
+    async def iter_similar_queries(
+        self,
+        prompt_embedding: List[float],
+        similarity_threshold: float = 0.7,
+        max_results: int = 5,
+        user_id: str = None
+    ) -> AsyncIterator[SimilarQuery]:
+        """Yield similar queries, optionally only one user's.
+
+        The matches come from a single match_queries call and are yielded one
+        by one so callers can serialize them as they go. With user_id set,
+        match_queries turns on pgvector's iterative index scan, so the user's
+        nearest rows are found even when other users' rows are closer.
+        """
+        params = {
+            'query_embedding': normalize_embedding(prompt_embedding),
+            'match_threshold': similarity_threshold,
+            'match_count': max_results
+        }
+        if user_id is not None:
+            params['filter_user_id'] = user_id
+
+        result = await _execute_with_retry(self.supabase.rpc('match_queries', params))
+
+        for row in result.data:
+            yield SimilarQuery(
+                row['id'],
+                row['user_id'],
+                row['prompt'],
+                row['response'],
+                row['similarity'],
+                row.get('keywords') or []
+            )
+
+    async def set_response_embedding(self, query_id: str, response_embedding: List[float]) -> None:
+        """Backfill the response embedding of a stored query."""
+        await self.supabase.table('queries').update(
+            {'response_embedding': response_embedding}
+        ).eq('id', query_id).execute()
+
+    async def touch_api_key(self, api_key: str) -> str:
+        """Return the owner of an active PromptLens API key, or None, setting its last_used_at."""
+        # Only sets a timestamp, so retrying it is as safe as retrying a read
+        result = await _execute_with_retry(self.supabase.rpc('touch_api_key', {'token': api_key}))
+        return result.data
+
+    async def touch_api_keys(self, api_keys: List[str]) -> None:
+        """Set last_used_at to now for the given API keys (timestamp set by the database)."""
+        await self.supabase.rpc('touch_api_keys', {'tokens': api_keys}).execute()
+
+    async def close(self) -> None:
+        """Close the underlying HTTP connections."""
+        await self.supabase.postgrest.aclose()
+
 # Global database service instance
 _db_service = None
 
@@ -110,3 +262,12 @@ def get_database_service() -> DatabaseService:
         _db_service = DatabaseService()
 
     return _db_service
+
+
+async def close_database_service() -> None:
+    """Close the global database service instance if it was created."""
+    global _db_service
+
+    if _db_service is not None:
+        await _db_service.close()
+        _db_service = None
@@ -3,117 +3,341 @@
 Adds LLM-based keyword extraction to reduce embedding cost and noise.
 """
 
+import asyncio
 import os
-from typing import List, Tuple
+import re
+from functools import lru_cache
+from typing import Iterator, List, Tuple
 import openai
-import anthropic
+import httpx
+import orjson
+import yake
 from dotenv import load_dotenv
+from cache import AsyncTTLCache, content_hash
 
 # Load environment variables
 load_dotenv()
 
+# Markdown code fences Claude sometimes wraps its JSON answer in
+_CODE_FENCE_RE = re.compile(r'```(?:json)?\n?|```')
+
+# YAKE keywords are used instead of Claude for short texts when the best
+# keyword scores at or below this (YAKE scores: lower is more relevant)
+_LOCAL_KEYWORD_MAX_SCORE = 0.1
+_LOCAL_KEYWORD_MAX_CHARS = 2000
+
+# Text sent to Claude for keywords is cut to roughly 2000 tokens (~4 chars each);
+# input length drives both cost and latency of the call
+_KEYWORD_INPUT_MAX_CHARS = 8000
+
+# Full-text embeddings are cut to this many characters, safely under the
+# model's 8191-token per-input limit even at one character per token; one
+# oversized input would fail its whole micro-batch
+_EMBEDDING_INPUT_MAX_CHARS = 8000
+
+
+@lru_cache(maxsize=8)
+def _yake_extractor(top: int) -> yake.KeywordExtractor:
+    """Get a shared YAKE extractor returning up to top keyphrases of 1-3 words."""
+    return yake.KeywordExtractor(lan="en", n=3, top=top)
+
+
+def _normalize_keywords(keywords: List[str], max_keywords: int) -> List[str]:
+    """Lowercase, collapse whitespace, strip punctuation and dedupe, keeping order."""
+    seen = set()
+    normalized: List[str] = []
+    for kw in keywords:
+        kw = " ".join(str(kw).lower().split())
+        kw = kw.strip(",.;:!?")
+        if kw and kw not in seen:
+            seen.add(kw)
+            normalized.append(kw)
+    return normalized[: max_keywords]
+
+
+# Process-wide HTTP/2 pool shared by every OpenAI client (embeddings and the
+# per-request generation clients), so they all reuse the same warm connections
+_openai_http_client: httpx.AsyncClient = None
+
+
+def get_openai_http_client() -> httpx.AsyncClient:
+    """Get or create the shared HTTP/2 connection pool for OpenAI clients."""
+    global _openai_http_client
+
+    if _openai_http_client is None or _openai_http_client.is_closed:
+        _openai_http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            http2=True
+        )
+
+    return _openai_http_client
+
 
 class EmbeddingService:
     """Simple service for generating text embeddings using OpenAI."""
 
     def __init__(self):
         """Initialize embedding service."""
+        # Large keep-alive pool over HTTP/2 so bursts of embedding calls share
+        # warm connections instead of paying TLS handshakes
         self.client = openai.AsyncOpenAI(
-            api_key=os.getenv("OPENAI_API_KEY")
+            api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=get_openai_http_client()
         )
         self.model = "text-embedding-3-small"
-        self.dimensions = 1536
-        # Claude client for keyword extraction
-        self.claude_client = anthropic.AsyncAnthropic(
-            api_key=os.getenv("ANTHROPIC_API_KEY")
-        )
+        self.dimensions = 512
+        # Claude client for keyword extraction, created on first use since YAKE
+        # handles most texts locally and the anthropic SDK is slow to import
+        self.claude_client = None
         self.keyword_model = os.getenv("KEYWORD_MODEL", "claude-3-haiku-20240307")
+        # Batching: concurrent generate_embedding calls arriving within
+        # batch_window seconds are coalesced into a single API request
+        self.batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+        self.batch_window = 0.01
+        self.max_batch_tokens = 300_000
+        self._batch_queue: asyncio.Queue = None
+        self._batch_worker: asyncio.Task = None
+        self._batch_tasks = set()
+        # Results keyed by content hash; identical texts skip the API entirely
+        self._embedding_cache = AsyncTTLCache(maxsize=10_000, ttl=86400)
+        self._keyword_cache = AsyncTTLCache(maxsize=10_000, ttl=86400)
 
     async def generate_embedding(self, text: str) -> List[float]:
         """
         Generate embedding for a single text string.
 
+        Results are cached by content hash, and calls made concurrently are
+        micro-batched into one embeddings request.
+
         Args:
             text: The text to generate embedding for
 
         Returns:
-            List of floats representing the embedding vector (1536 dimensions)
+            List of floats representing the embedding vector (512 dimensions)
+
+        Raises:
+            Exception: If embedding generation fails
+        """
+        key = content_hash(f"{self.model}:{self.dimensions}", text)
+        return await self._embedding_cache.get_or_compute(key, lambda: self._queue_embedding(text))
+
+    async def _queue_embedding(self, text: str) -> List[float]:
+        """Queue text for the micro-batcher and wait for its embedding."""
+        future = asyncio.get_running_loop().create_future()
+        if self._batch_worker is None or self._batch_worker.done():
+            self._batch_queue = asyncio.Queue()
+            self._batch_worker = asyncio.create_task(self._run_batch_worker(self._batch_queue))
+        self._batch_queue.put_nowait((text, future))
+        return await future
+
+    async def generate_embeddings(self, texts: List[str], batch_size: int = None) -> List[List[float]]:
+        """
+        Generate embeddings for many texts using as few API requests as possible.
+
+        Args:
+            texts: The texts to generate embeddings for
+            batch_size: Maximum texts per request (defaults to self.batch_size)
+
+        Returns:
+            One embedding per input text, in the same order as texts
 
         Raises:
             Exception: If embedding generation fails
         """
+        embeddings: List[List[float]] = []
+        for batch in self._chunk_texts(texts, batch_size or self.batch_size):
+            embeddings.extend(await self._embed_batch(batch))
+        return embeddings
+
+    def _chunk_texts(self, texts: List[str], batch_size: int) -> Iterator[List[str]]:
+        """Split texts into batches bounded by size and an estimated token budget."""
+        batch: List[str] = []
+        batch_tokens = 0
+        for text in texts:
+            # Rough estimate of ~4 characters per token keeps us under the per-request cap
+            tokens = len(text) // 4 + 1
+            if batch and (len(batch) >= batch_size or batch_tokens + tokens > self.max_batch_tokens):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            yield batch
+
+    async def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embed a single batch of texts in one API request."""
         try:
             response = await self.client.embeddings.create(
                 model=self.model,
-                input=text,
+                input=texts,
                 dimensions=self.dimensions
             )
 
-            return response.data[0].embedding
+            return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
 
         except Exception as e:
             raise Exception(f"Embedding generation failed: {str(e)}")
 
+    async def _run_batch_worker(self, queue: asyncio.Queue) -> None:
+        """Drain queued texts into batches until the queue is empty."""
+        loop = asyncio.get_running_loop()
+        while not queue.empty():
+            pending = [queue.get_nowait()]
+            deadline = loop.time() + self.batch_window
+            while len(pending) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Flush in the background so the next batch can be collected meanwhile
+            task = loop.create_task(self._flush_batch(pending))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _flush_batch(self, pending: List[Tuple[str, asyncio.Future]]) -> None:
+        """Embed a batch of queued texts and resolve each caller's future."""
+        # Drop texts whose callers were cancelled while the batch was collected
+        pending = [(text, future) for text, future in pending if not future.done()]
+        if not pending:
+            return
+        texts = [text for text, _ in pending]
+        try:
+            results = await self.generate_embeddings(texts)
+        except Exception:
+            # Retry one text per request so a single bad input only fails its own caller
+            results = await asyncio.gather(
+                *(self._embed_batch([text]) for text in texts), return_exceptions=True
+            )
+            results = [r if isinstance(r, BaseException) else r[0] for r in results]
+
+        for (_, future), result in zip(pending, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
     async def extract_keywords(self, text: str, max_keywords: int = 3) -> List[str]:
         """
-        Use Claude to extract important keywords/phrases from text.
+        Extract important keywords/phrases from text.
+
+        Short texts are handled locally by YAKE when it is confident; anything
+        else goes to Claude, which only sees the first ~2000 tokens of text.
 
         Returns a list of 2-3 words (no punctuation), lowercased, unique.
         """
+        key = content_hash(f"{self.keyword_model}:{max_keywords}", text)
+        try:
+            return await self._keyword_cache.get_or_compute(
+                key, lambda: self._compute_keywords(text, max_keywords)
+            )
+        except Exception as e:
+            # Graceful fallback: return empty to signal caller to use full text
+            return []
+
+    async def _compute_keywords(self, text: str, max_keywords: int) -> List[str]:
+        """Try local YAKE extraction first and fall back to Claude."""
+        if len(text) < _LOCAL_KEYWORD_MAX_CHARS:
+            try:
+                scored = await asyncio.to_thread(_yake_extractor(max_keywords).extract_keywords, text)
+            except Exception:
+                scored = []
+            if scored and scored[0][1] <= _LOCAL_KEYWORD_MAX_SCORE:
+                return _normalize_keywords([kw for kw, _ in scored], max_keywords)
+        return await self._request_keywords(text, max_keywords)
+
+    async def _request_keywords(self, text: str, max_keywords: int) -> List[str]:
+        """Ask Claude for keywords; raises if the API call itself fails."""
         prompt = (
             "Extract AT MOST "
             f"{max_keywords} concise keywords that best represent the content. "
             "Return them as a JSON array of strings only."
         )
-        try:
-            resp = await self.claude_client.messages.create(
-                model=self.keyword_model,
-                max_tokens=256,
-                temperature=0.2,
-                system="You extract salient keywords.",
-                messages=[
-                    {"role": "user", "content": f"Text:\n{text}\n\n{prompt}"}
-                ]
+        text = text[:_KEYWORD_INPUT_MAX_CHARS]
+        if self.claude_client is None:
+            import anthropic
+            self.claude_client = anthropic.AsyncAnthropic(
+                api_key=os.getenv("ANTHROPIC_API_KEY")
             )
-            content = resp.content[0].text if resp.content else "[]"
-            import json
-            import re
+        resp = await self.claude_client.messages.create(
+            model=self.keyword_model,
+            max_tokens=256,
+            temperature=0.2,
+            system="You extract salient keywords.",
+            messages=[
+                {"role": "user", "content": f"Text:\n{text}\n\n{prompt}"}
+            ]
+        )
+        content = resp.content[0].text if resp.content else "[]"
 
+        keywords = []
+        try:
+            # Remove any markdown code blocks and parse JSON
+            clean_content = _CODE_FENCE_RE.sub('', content).strip()
+            parsed = orjson.loads(clean_content)
+            if isinstance(parsed, list):
+                keywords = parsed
+        except Exception:
+            # Fallback: return empty list
             keywords = []
-            try:
-                # Remove any markdown code blocks and parse JSON
-                clean_content = re.sub(r'```(?:json)?\n?|```', '', content).strip()
-                parsed = json.loads(clean_content)
-                if isinstance(parsed, list):
-                    keywords = [str(k).strip().lower() for k in parsed if str(k).strip()]
-            except Exception:
-                # Fallback: return empty list
-                keywords = []
-            # Normalize: limit token length per phrase, dedupe, keep order
-            seen = set()
-            normalized: List[str] = []
-            for kw in keywords:
-                kw = " ".join(kw.split())
-                kw = kw.strip(",.;:!?")
-                if kw and kw not in seen:
-                    seen.add(kw)
-                    normalized.append(kw)
-            return normalized[: max_keywords]
-        except Exception as e:
-            # Graceful fallback: return empty to signal caller to use full text
-            return []
+        return _normalize_keywords(keywords, max_keywords)
 
     async def generate_keyword_embedding(self, text: str, max_keywords: int = 3) -> Tuple[List[float], List[str]]:
         """
         Extract keywords and embed the joined keyword string. Falls back to full text when needed.
 
+        Keywords for long texts reflect only their first ~2000 tokens.
+
+        The fallback embeds at most the first _EMBEDDING_INPUT_MAX_CHARS
+        characters. For texts within that limit it is started speculatively
+        alongside keyword extraction, so the fallback costs no extra latency.
+        The speculation is cancelled when keywords come back; if it is still
+        queued for the micro-batcher it is never sent, and a concurrent
+        request embedding the same text keeps it running.
+
         Returns (embedding, keywords_used)
         """
-        keywords = await self.extract_keywords(text, max_keywords=max_keywords)
-        material = ", ".join(keywords) if keywords else text
-        embedding = await self.generate_embedding(material)
+        fulltext = text[:_EMBEDDING_INPUT_MAX_CHARS]
+        keyword_task = asyncio.create_task(self.extract_keywords(text, max_keywords=max_keywords))
+        fulltext_task = None
+        if len(text) <= _EMBEDDING_INPUT_MAX_CHARS:
+            fulltext_task = asyncio.create_task(self.generate_embedding(fulltext))
+            # Observe the speculative task's outcome so an unused failure is not logged
+            fulltext_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        try:
+            keywords = await keyword_task
+            if keywords:
+                if fulltext_task is not None:
+                    fulltext_task.cancel()
+                embedding = await self.generate_embedding(", ".join(keywords))
+            elif fulltext_task is not None:
+                embedding = await fulltext_task
+            else:
+                embedding = await self.generate_embedding(fulltext)
+        finally:
+            keyword_task.cancel()
+            if fulltext_task is not None:
+                fulltext_task.cancel()
         return embedding, keywords
 
+    async def warm_up(self, connections: int = 4) -> None:
+        """Pre-establish pooled connections to the embeddings API with cheap requests."""
+        await asyncio.gather(
+            *(self.client.models.list() for _ in range(connections)),
+            return_exceptions=True
+        )
+
+    async def close(self) -> None:
+        """Close the underlying HTTP connections, including the shared OpenAI pool."""
+        await self.client.close()
+        if self.claude_client is not None:
+            await self.claude_client.close()
+
 
 # Global embedding service instance
 _embedding_service = None
@@ -127,3 +351,12 @@ def get_embedding_service() -> EmbeddingService:
         _embedding_service = EmbeddingService()
 
     return _embedding_service
+
+
+async def close_embedding_service() -> None:
+    """Close the global embedding service instance if it was created."""
+    global _embedding_service
+
+    if _embedding_service is not None:
+        await _embedding_service.close()
+        _embedding_service = None
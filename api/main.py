@@ -1,32 +1,46 @@
 """Simple FastAPI application."""
-from typing import Optional, List
-from fastapi import FastAPI, HTTPException, Depends, Security
+import asyncio
+from contextlib import aclosing, asynccontextmanager
+from functools import lru_cache
+from typing import TYPE_CHECKING, AsyncIterator, Optional, List, Tuple, Union
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Depends, Request, Security
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, ConfigDict, Field
 from enum import Enum
+import logging
 import openai
-import anthropic
+import hashlib
 import httpx
+import jwt
+from cachetools import TTLCache
+import orjson
 import os
-from supabase import create_client, Client
-import datetime
 import time
 import random
 from dotenv import load_dotenv
+
+if TYPE_CHECKING:
+    import anthropic
+
 load_dotenv()
 
-# Initialize Supabase client
-supabase_url = os.getenv("SUPABASE_URL", "")
-supabase_key = os.getenv("SUPABASE_API", "")
-supabase: Client = create_client(supabase_url, supabase_key) if supabase_url and supabase_key else None
+# Supabase is reached through the async client in DatabaseService
+supabase_configured = bool(os.getenv("SUPABASE_URL") and os.getenv("SUPABASE_API"))
+# With the project's JWT secret, user access tokens are verified without calling Supabase Auth
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
 
 # Security
 security = HTTPBearer()
 
+logger = logging.getLogger(__name__)
+
 # Import database and embedding services
-from database import get_database_service
-from embedding_service import get_embedding_service
+from database import SimilarQuery, get_database_service, close_database_service
+from cache import AsyncTTLCache, SingleFlight
+from embedding_service import get_embedding_service, close_embedding_service, get_openai_http_client
 
 # Models and Enums
 class Provider(str, Enum):
@@ -36,9 +50,37 @@ class Provider(str, Enum):
     XAI = "xai"
 
 
+# Model used when a request doesn't name one
+DEFAULT_MODELS = {
+    Provider.OPENAI: "gpt-4o",
+    Provider.ANTHROPIC: "claude-3-haiku-20240307",
+    Provider.XAI: "grok-3",
+}
+
+# Context windows in tokens, for rejecting requests that cannot fit before
+# calling upstream; models not listed are left to the provider to check
+MODEL_CONTEXT_LIMITS = {
+    "gpt-4o": 128_000,
+    "gpt-4o-mini": 128_000,
+    "gpt-4-turbo": 128_000,
+    "gpt-4": 8_192,
+    "gpt-3.5-turbo": 16_385,
+    "claude-3-haiku-20240307": 200_000,
+    "claude-3-5-haiku-20241022": 200_000,
+    "claude-3-5-sonnet-20241022": 200_000,
+    "claude-3-opus-20240229": 200_000,
+    "grok-3": 131_072,
+    "grok-3-mini": 131_072,
+}
+
+
 class GenerateRequest(BaseModel):
     """Request model for text generation."""
-    prompt: str = Field(..., description="The prompt to generate text from")
+    # Requests are never mutated after parsing; extra fields (e.g. user_id from
+    # older clients) are still ignored rather than rejected
+    model_config = ConfigDict(frozen=True)
+
+    prompt: str = Field(..., max_length=100_000, description="The prompt to generate text from")
     provider: Provider = Field(..., description="LLM provider to use")
     api_key: str = Field(..., description="API key for the LLM provider (OpenAI, Anthropic, or XAI)")
     # Optional LLM parameters
@@ -62,35 +104,178 @@ class GenerateResponse(BaseModel):
     similarity_score: Optional[float] = None
 
 
+
+class SimilarRequest(BaseModel):
+    """Request model for similar query search."""
+    model_config = ConfigDict(frozen=True)
+
+    prompt: str = Field(..., description="The prompt to find similar queries for")
+    similarity_threshold: float = Field(0.7, ge=0.0, le=1.0, description="Minimum similarity score")
+    # match_queries searches with hnsw.ef_search = 100, which bounds the candidates
+    max_results: int = Field(5, ge=1, le=100, description="Maximum number of results")
+
 # Authentication functions
+# Verified tokens are cached briefly so repeat callers skip Supabase; a revoked
+# key keeps working until its entry expires
+_AUTH_CACHE_TTL = 60
+_auth_cache = AsyncTTLCache(maxsize=10_000, ttl=_AUTH_CACHE_TTL)
+# PromptLens API keys used since the last flush of last_used_at
+_used_api_keys = set()
+_API_KEY_FLUSH_INTERVAL = 5.0
+
+
+async def _lookup_user_id(token: str) -> str:
+    """Resolve a PromptLens API key or Supabase JWT to a user ID."""
+    db_service = get_database_service()
+
+    # Check if it's a PromptLens API key; the lookup also sets its last_used_at
+    if token.startswith('pl_'):
+        user_id = await db_service.touch_api_key(token)
+        if user_id:
+            return user_id
+        raise ValueError("Unknown or inactive API key")
+
+    # Otherwise, try to verify as Supabase JWT
+    if SUPABASE_JWT_SECRET:
+        claims = jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=["HS256"], audience="authenticated")
+        return claims["sub"]
+
+    user = await db_service.supabase.auth.get_user(token)
+    if user and user.user:
+        return user.user.id
+
+    raise ValueError("Invalid API key")
+
+
+def _cacheable(token: str) -> bool:
+    """Return whether a token's user ID may be cached for the full auth cache TTL."""
+    if token.startswith('pl_'):
+        return True
+    if SUPABASE_JWT_SECRET:
+        # Verifying locally costs no more than a cache hit and checks exp every time
+        return False
+    # A JWT that expires before its cache entry would must be checked each time;
+    # the signature is verified by Supabase Auth on the lookup itself
+    try:
+        expires_at = jwt.decode(token, options={"verify_signature": False})["exp"]
+    except Exception:
+        return False
+    return expires_at - time.time() > _AUTH_CACHE_TTL
+
+
 async def verify_api_key(credentials: HTTPAuthorizationCredentials = Security(security)) -> str:
     """Verify API key and return user ID."""
-    if not supabase:
+    if not supabase_configured:
         raise HTTPException(status_code=500, detail="Supabase not configured")
 
     token = credentials.credentials
+    # A lookup, whether this caller's or one it shares while in flight, sets
+    # last_used_at itself; only keys resolved from a finished entry need the flush
+    resolved_from_cache = False
 
     try:
-        # Check if it's a PromptLens API key
-        if token.startswith('pl_'):
-            result = supabase.table('user_api_keys').select('user_id').eq('api_key', token).eq('is_active', True).single().execute()
-            if result.data:
-                # Update last_used_at
-                supabase.table('user_api_keys').update({'last_used_at': datetime.datetime.utcnow().isoformat()}).eq('api_key', token).execute()
-                return result.data['user_id']
-
-        # Otherwise, try to verify as Supabase JWT
-        user = supabase.auth.get_user(token)
-        if user and user.user:
-            return user.user.id
+        if _cacheable(token):
+            resolved_from_cache = _auth_cache.has_value(token)
+            user_id = await _auth_cache.get_or_compute(token, lambda: _lookup_user_id(token))
+        else:
+            user_id = await _lookup_user_id(token)
+    except Exception as e:
+        logger.debug("API key verification failed: %s", e)
+        raise HTTPException(status_code=401, detail="Invalid API key")
 
+    if token.startswith('pl_') and resolved_from_cache:
+        _used_api_keys.add(token)
+    return user_id
+
+
+async def flush_api_key_usage() -> None:
+    """Set last_used_at for every API key used since the previous flush."""
+    if not _used_api_keys:
+        return
+
+    tokens = list(_used_api_keys)
+    _used_api_keys.clear()
+    try:
+        await get_database_service().touch_api_keys(tokens)
     except Exception:
-        pass
+        # Keep the keys so the next flush retries them
+        logger.exception("Failed to record API key usage")
+        _used_api_keys.update(tokens)
+
 
-    raise HTTPException(status_code=401, detail="Invalid API key")
+async def record_api_key_usage():
+    """Flush API key usage to the database on a fixed interval."""
+    while True:
+        await asyncio.sleep(_API_KEY_FLUSH_INTERVAL)
+        await flush_api_key_usage()
 
 
 # LLM Service Classes
+# Provider clients are cached per API key so repeat callers skip client setup.
+# OpenAI clients share the embedding service's pool; Anthropic clients share
+# one pool of their own, so evicting a client never drops warm connections.
+@lru_cache(maxsize=512)
+def _openai_client(api_key: str) -> openai.AsyncOpenAI:
+    """Get the cached OpenAI client for an API key."""
+    # Completions keep the SDK's longer default timeout
+    return openai.AsyncOpenAI(
+        api_key=api_key,
+        http_client=get_openai_http_client(),
+        timeout=openai.DEFAULT_TIMEOUT
+    )
+
+
+# anthropic is imported on first use: workers that never serve Anthropic
+# traffic skip loading the SDK
+@lru_cache(maxsize=1)
+def _anthropic_http_client() -> "anthropic.DefaultAsyncHttpxClient":
+    """Get the connection pool shared by all Anthropic clients."""
+    import anthropic
+    return anthropic.DefaultAsyncHttpxClient()
+
+
+@lru_cache(maxsize=512)
+def _anthropic_client(api_key: str) -> "anthropic.AsyncAnthropic":
+    """Get the cached Anthropic client for an API key."""
+    import anthropic
+    return anthropic.AsyncAnthropic(api_key=api_key, http_client=_anthropic_http_client())
+
+
+async def close_llm_clients() -> None:
+    """Drop cached provider clients and close the Anthropic pool."""
+    _openai_client.cache_clear()
+    _anthropic_client.cache_clear()
+    if _anthropic_http_client.cache_info().currsize:
+        await _anthropic_http_client().aclose()
+        _anthropic_http_client.cache_clear()
+
+
+XAI_BASE_URL = "https://api.x.ai/v1"
+
+
+def _xai_request(request: GenerateRequest, stream: bool):
+    """Build the model, headers and payload for an XAI chat completion."""
+    # XAI uses OpenAI-compatible API
+    headers = {
+        "Authorization": f"Bearer {request.api_key}",
+        "Content-Type": "application/json"
+    }
+
+    model = request.model or DEFAULT_MODELS[Provider.XAI]
+
+    payload = {
+        "model": model,
+        "messages": [{"role": "user", "content": request.prompt}],
+        "temperature": request.temperature,
+        "max_tokens": request.max_tokens,
+        "top_p": request.top_p,
+        "frequency_penalty": request.frequency_penalty,
+        "presence_penalty": request.presence_penalty,
+        "stream": stream
+    }
+    return model, headers, payload
+
+
 class LLMService:
     """Base class for LLM services."""
 
@@ -98,9 +283,9 @@ class LLMService:
     async def generate_openai(request: GenerateRequest, user_id: str) -> GenerateResponse:
         """Generate text using OpenAI API."""
         try:
-            client = openai.AsyncOpenAI(api_key=request.api_key)
+            client = _openai_client(request.api_key)
             # Default model selection
-            model = request.model or "gpt-4o"
+            model = request.model or DEFAULT_MODELS[Provider.OPENAI]
 
             response = await client.chat.completions.create(
                 model=model,
@@ -126,9 +311,9 @@ class LLMService:
     async def generate_anthropic(request: GenerateRequest, user_id: str) -> GenerateResponse:
         """Generate text using Anthropic API."""
         try:
-            client = anthropic.AsyncAnthropic(api_key=request.api_key)
+            client = _anthropic_client(request.api_key)
             # Default model selection
-            model = request.model or "claude-3-haiku-20240307"
+            model = request.model or DEFAULT_MODELS[Provider.ANTHROPIC]
 
             response = await client.messages.create(
                 model=model,
@@ -149,75 +334,189 @@ class LLMService:
             raise HTTPException(status_code=400, detail=f"Anthropic API error: {str(e)}")
 
     @staticmethod
-    async def generate_xai(request: GenerateRequest, user_id: str) -> GenerateResponse:
-        """Generate text using XAI API."""
+    async def generate_xai(request: GenerateRequest, user_id: str, client: httpx.AsyncClient) -> GenerateResponse:
+        """Generate text using XAI API over the shared XAI connection pool."""
         try:
-            # XAI uses OpenAI-compatible API
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                headers = {
-                    "Authorization": f"Bearer {request.api_key}",
-                    "Content-Type": "application/json"
-                }
-
-                # Default model selection - XAI models
-                model = request.model or "grok-3"
-
-                payload = {
-                    "model": model,
-                    "messages": [{"role": "user", "content": request.prompt}],
-                    "temperature": request.temperature,
-                    "max_tokens": request.max_tokens,
-                    "top_p": request.top_p,
-                    "frequency_penalty": request.frequency_penalty,
-                    "presence_penalty": request.presence_penalty,
-                    "stream": False
-                }
-
-                response = await client.post(
-                    "https://api.x.ai/v1/chat/completions",
-                    headers=headers,
-                    json=payload
+            model, headers, payload = _xai_request(request, stream=False)
+
+            response = await client.post("/chat/completions", headers=headers, json=payload)
+
+            # The body is only decoded to text for error messages
+            if response.status_code != 200:
+                raise HTTPException(
+                    status_code=response.status_code,
+                    detail=f"XAI API error (status {response.status_code}): {response.text}"
                 )
 
-                response_text = response.text
-
-                if response.status_code != 200:
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail=f"XAI API error (status {response.status_code}): {response_text}"
-                    )
-
-                try:
-                    data = response.json()
-                except Exception as json_error:
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Failed to parse XAI response as JSON: {json_error}. Response: {response_text}"
-                    )
-
-                if "choices" not in data or not data["choices"]:
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Invalid XAI response format: {data}"
-                    )
-
-                return GenerateResponse(
-                    generated_text=data["choices"][0]["message"]["content"],
-                    provider="xai",
-                    model_used=data.get("model", model),
-                    usage=data.get("usage", {}),
-                    user_id=user_id
+            try:
+                data = orjson.loads(response.content)
+            except orjson.JSONDecodeError as json_error:
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Failed to parse XAI response as JSON: {json_error}. Response: {response.text}"
                 )
 
+            if "choices" not in data or not data["choices"]:
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Invalid XAI response format: {data}"
+                )
+
+            return GenerateResponse(
+                generated_text=data["choices"][0]["message"]["content"],
+                provider="xai",
+                model_used=data.get("model", model),
+                usage=data.get("usage", {}),
+                user_id=user_id
+            )
+
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"XAI API unexpected error: {str(e)}")
 
+    # Streaming variants yield text deltas as they arrive, then a final
+    # GenerateResponse with the full text and usage. Its fields are built
+    # here rather than parsed from a response body, so it skips validation.
+
+    @staticmethod
+    async def stream_openai(request: GenerateRequest, user_id: str) -> AsyncIterator[Union[str, GenerateResponse]]:
+        """Stream text from the OpenAI API."""
+        client = _openai_client(request.api_key)
+        model = request.model or DEFAULT_MODELS[Provider.OPENAI]
+
+        stream = await client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": request.prompt}],
+            temperature=request.temperature,
+            max_tokens=request.max_tokens,
+            top_p=request.top_p,
+            frequency_penalty=request.frequency_penalty,
+            presence_penalty=request.presence_penalty,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+
+        parts = []
+        usage = {}
+        async for chunk in stream:
+            model = chunk.model or model
+            if chunk.usage:
+                usage = chunk.usage.model_dump()
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+
+        yield GenerateResponse.model_construct(
+            generated_text="".join(parts),
+            provider="openai",
+            model_used=model,
+            usage=usage,
+            user_id=user_id
+        )
+
+    @staticmethod
+    async def stream_anthropic(request: GenerateRequest, user_id: str) -> AsyncIterator[Union[str, GenerateResponse]]:
+        """Stream text from the Anthropic API."""
+        client = _anthropic_client(request.api_key)
+        model = request.model or DEFAULT_MODELS[Provider.ANTHROPIC]
+
+        async with client.messages.stream(
+            model=model,
+            max_tokens=request.max_tokens,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            messages=[{"role": "user", "content": request.prompt}]
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            message = await stream.get_final_message()
+
+        yield GenerateResponse.model_construct(
+            generated_text="".join(block.text for block in message.content if block.type == "text"),
+            provider="anthropic",
+            model_used=message.model,
+            usage=message.usage.model_dump() if message.usage else {},
+            user_id=user_id
+        )
+
+    @staticmethod
+    async def stream_xai(
+        request: GenerateRequest, user_id: str, client: httpx.AsyncClient
+    ) -> AsyncIterator[Union[str, GenerateResponse]]:
+        """Stream text from the XAI API, which sends OpenAI-style SSE chunks."""
+        model, headers, payload = _xai_request(request, stream=True)
+
+        parts = []
+        usage = {}
+        async with client.stream("POST", "/chat/completions", headers=headers, json=payload) as response:
+            if response.status_code != 200:
+                body = await response.aread()
+                raise HTTPException(
+                    status_code=response.status_code,
+                    detail=f"XAI API error (status {response.status_code}): {body.decode(errors='replace')}"
+                )
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                if line == "data: [DONE]":
+                    break
+                chunk = orjson.loads(line[6:])
+                model = chunk.get("model", model)
+                usage = chunk.get("usage") or usage
+                choices = chunk.get("choices")
+                text = choices[0].get("delta", {}).get("content") if choices else None
+                if text:
+                    parts.append(text)
+                    yield text
+
+        yield GenerateResponse.model_construct(
+            generated_text="".join(parts),
+            provider="xai",
+            model_used=model,
+            usage=usage,
+            user_id=user_id
+        )
+
+
+async def warm_connection_pools():
+    """Open connections to upstream APIs before the first request needs them."""
+    try:
+        await get_embedding_service().warm_up()
+    except Exception:
+        # Warming is best effort; requests will open connections on demand
+        pass
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm shared connection pools on startup and release them on shutdown."""
+    # One long-lived XAI client so requests reuse warm connections to api.x.ai;
+    # HTTP/2 multiplexes concurrent requests over a few TLS connections, and
+    # idle connections are kept for a minute between bursts
+    app.state.xai_client = httpx.AsyncClient(
+        base_url=XAI_BASE_URL,
+        timeout=httpx.Timeout(30.0, connect=5.0),
+        limits=httpx.Limits(max_connections=500, max_keepalive_connections=100, keepalive_expiry=60.0),
+        http2=True
+    )
+    warm_task = asyncio.create_task(warm_connection_pools())
+    usage_task = asyncio.create_task(record_api_key_usage())
+    yield
+    warm_task.cancel()
+    usage_task.cancel()
+    await flush_api_key_usage()
+    await app.state.xai_client.aclose()
+    await close_llm_clients()
+    await close_embedding_service()
+    await close_database_service()
+
 
 # Create FastAPI app
 app = FastAPI(
     title="PromptLens API",
     version="1.0.0",
-    description="API for PromptLens - LLM Data Insights Platform"
+    description="API for PromptLens - LLM Data Insights Platform",
+    lifespan=lifespan
 )
 
 # Add CORS middleware
@@ -229,6 +528,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Long generations compress 3-4x; level 5 keeps the CPU cost low. SSE
+# streams are left uncompressed by the middleware so events aren't held back.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 
 @app.get("/")
 async def root():
@@ -242,8 +545,181 @@ async def health():
     return {"status": "healthy"}
 
 
+def _check_context_window(request: GenerateRequest) -> None:
+    """Reject a request whose prompt and max_tokens cannot fit the model's context."""
+    model = request.model or DEFAULT_MODELS[request.provider]
+    limit = MODEL_CONTEXT_LIMITS.get(model)
+    # Roughly four characters per token; errs towards letting requests through
+    estimated_tokens = len(request.prompt) // 4 + (request.max_tokens or 0)
+    if limit is not None and estimated_tokens > limit:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Prompt and max_tokens (~{estimated_tokens} tokens) exceed the {limit}-token context window of {model}"
+        )
+
+
+# Deterministic generations currently in flight, keyed by _request_key
+_inflight_generations = SingleFlight()
+# Stored results of deterministic generations, with their prompt embeddings, so
+# exact repeats skip the prompt embedding, the similarity search and the provider
+_exact_generations = TTLCache(maxsize=1_000, ttl=86400)
+
+
+def _is_deterministic(request: GenerateRequest) -> bool:
+    """Whether repeating the request should produce the same completion."""
+    return request.temperature == 0 or request.top_p == 0
+
+
+def _request_key(request: GenerateRequest) -> str:
+    """Hash every field of a generation request, including the provider key."""
+    body = orjson.dumps(request.model_dump(mode="json"), option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+# Provider handlers by provider, called as handler(request, user_id, xai_client);
+# only XAI uses the app's shared client
+_GENERATE = {
+    Provider.OPENAI: lambda request, user_id, xai_client: LLMService.generate_openai(request, user_id),
+    Provider.ANTHROPIC: lambda request, user_id, xai_client: LLMService.generate_anthropic(request, user_id),
+    Provider.XAI: LLMService.generate_xai,
+}
+_STREAM = {
+    Provider.OPENAI: lambda request, user_id, xai_client: LLMService.stream_openai(request, user_id),
+    Provider.ANTHROPIC: lambda request, user_id, xai_client: LLMService.stream_anthropic(request, user_id),
+    Provider.XAI: lambda request, user_id, xai_client: LLMService.stream_xai(request, user_id, xai_client),
+}
+
+
+# Caps on concurrent upstream calls per provider, so bursts queue here instead
+# of flooding the provider into 429s and retry storms
+_PROVIDER_LIMITS = {
+    Provider.OPENAI: asyncio.Semaphore(int(os.getenv("OPENAI_MAX_CONCURRENCY", "64"))),
+    Provider.ANTHROPIC: asyncio.Semaphore(int(os.getenv("ANTHROPIC_MAX_CONCURRENCY", "32"))),
+    Provider.XAI: asyncio.Semaphore(int(os.getenv("XAI_MAX_CONCURRENCY", "32"))),
+}
+
+
+async def _call_provider(request: GenerateRequest, user_id: str, xai_client: httpx.AsyncClient) -> GenerateResponse:
+    """Generate a completion with the requested provider."""
+    async with _PROVIDER_LIMITS[request.provider]:
+        return await _GENERATE[request.provider](request, user_id, xai_client)
+
+
+async def _find_cached_query(
+    request: GenerateRequest, db_service
+) -> Tuple[Optional[SimilarQuery], List[float], List[str]]:
+    """Return a stored query that is an exact repeat or >95% similar, if any.
+
+    Also returns the prompt embedding and keywords. An exact repeat of a
+    deterministic request is answered from _exact_generations, with the
+    embedding and keywords stored alongside it, before any embedding work.
+    """
+    if _is_deterministic(request):
+        exact = _exact_generations.get(_request_key(request))
+        if exact is not None:
+            cached_query, prompt_embedding = exact
+            return cached_query, prompt_embedding, cached_query.keywords
+
+    # LLM-extracted keywords; for very long prompts these only reflect the
+    # first ~2000 tokens
+    prompt_embedding, prompt_keywords = await get_embedding_service().generate_keyword_embedding(request.prompt)
+
+    # One round trip for the nearest row; its text is small next to a second
+    # request, and its response embedding is reused when storing this query
+    similar_queries = await db_service.find_similar_queries(
+        prompt_embedding=prompt_embedding,
+        similarity_threshold=0.95,
+        max_results=1,
+        include_response_embedding=True
+    )
+    cached_query = similar_queries[0] if similar_queries else None
+    return cached_query, prompt_embedding, prompt_keywords
+
+
+def _tokens_used(usage: dict) -> int:
+    """Total tokens from a provider usage dict."""
+    if not isinstance(usage, dict):
+        return 0
+    # For OpenAI and XAI, usage typically has 'total_tokens'
+    tokens_used = usage.get('total_tokens', 0)
+    # If total_tokens not available, sum prompt_tokens and completion_tokens
+    if tokens_used == 0:
+        tokens_used = usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0)
+    # For Anthropic, usage has 'input_tokens' and 'output_tokens'
+    if tokens_used == 0:
+        tokens_used = usage.get('input_tokens', 0) + usage.get('output_tokens', 0)
+    return tokens_used
+
+
+async def _record_query(
+    request: GenerateRequest,
+    user_id: str,
+    prompt_embedding: List[float],
+    prompt_keywords: List[str],
+    response_text: str,
+    model_used: str,
+    tokens_used: int,
+    response_time_ms: int,
+    cached_query_id: str = None,
+    response_embedding: Optional[List[float]] = None
+) -> str:
+    """Store the query with its response embedding, embedding the response if needed.
+
+    A cache hit passes the cached row's response_embedding, so the response
+    is only embedded for fresh generations and for cached rows stored
+    without one, which are backfilled.
+
+    Returns the stored query ID.
+    """
+    if response_embedding is None:
+        # Generate embedding for the response using keywords
+        response_embedding, _ = await get_embedding_service().generate_keyword_embedding(response_text)
+        if cached_query_id is not None:
+            await get_database_service().set_response_embedding(cached_query_id, response_embedding)
+
+    query_id = await get_database_service().store_query(
+        user_id=user_id,
+        prompt=request.prompt,
+        response=response_text,
+        prompt_embedding=prompt_embedding,
+        response_embedding=response_embedding,
+        cached_query_id=cached_query_id,
+        model_used=model_used,
+        tokens_used=tokens_used,
+        response_time_ms=response_time_ms,
+        # A random rating between 2-5 because we're too lazy to implement a real rating system
+        rating=random.randint(2, 5),
+        keywords=prompt_keywords  # Use LLM-extracted keywords from prompt
+    )
+
+    if cached_query_id is None and _is_deterministic(request):
+        _exact_generations[_request_key(request)] = (
+            SimilarQuery(query_id, user_id, request.prompt, response_text, 1.0, prompt_keywords, response_embedding),
+            prompt_embedding
+        )
+    return query_id
+
+
+async def _record_query_logged(*args, **kwargs) -> None:
+    """Run _record_query after a response has been sent, logging any failure."""
+    try:
+        await _record_query(*args, **kwargs)
+    except Exception:
+        logger.exception("Failed to store query")
+
+
+def _elapsed_ms(start_time: float) -> int:
+    """Milliseconds since start_time."""
+    return int((time.time() - start_time) * 1000)
+
+
 @app.post("/api/generate", response_model=GenerateResponse)
-async def generate(request: GenerateRequest, user_id: str = Depends(verify_api_key)):
+async def generate(
+    request: GenerateRequest,
+    http_request: Request,
+    background_tasks: BackgroundTasks,
+    user_id: str = Depends(verify_api_key)
+):
     """
     Generate text using the specified LLM provider with embedding-based caching.
 
@@ -252,64 +728,49 @@ async def generate(request: GenerateRequest, user_id: str = Depends(verify_api_k
     2. Searches for similar prompts in the database
     3. If a close match is found (similarity > 0.95), returns the cached response
     4. If no close match, queries the LLM provider
-    5. Stores the new prompt, response, and embeddings in the database
+    5. Stores the new prompt, response, and embeddings in the database,
+       after the response has been sent
 
     Args:
         request: Generation request with prompt, provider, and parameters
+        http_request: Incoming HTTP request, for the app's shared clients
+        background_tasks: Tasks run after the response, for storage
         user_id: Authenticated user ID from API key
     Returns:
         Generated text with metadata, including cache status
 
     Raises:
-        HTTPException: If generation fails or provider is unsupported
+        HTTPException: If generation fails or provider is unsupported, or 413
+            if the prompt cannot fit the model's context window
     """
+    _check_context_window(request)
     try:
         start_time = time.time()
-        # Get services
-        db_service = get_database_service()
-        embedding_service = get_embedding_service()
-
-        # Step 1: Generate embedding for the prompt (LLM-extracted keywords)
-        prompt_embedding, prompt_keywords = await embedding_service.generate_keyword_embedding(request.prompt)
-
-        # Step 2: Search for similar queries in database
-        similar_queries = db_service.find_similar_queries(
-            prompt_embedding=prompt_embedding,
-            similarity_threshold=0.7,  # Lower threshold for search
-            max_results=1
-        )
-
-        # Generate a random rating between 2-5 because we're too lazy to implement a real rating system
-        rating = random.randint(2, 5)
-
-        # Step 3: Check if we have a very close match (>95% similarity)
-        if similar_queries and similar_queries[0].similarity_score > 0.95:
-            # Use cached response but still store this query in database
-            cached_query = similar_queries[0]
-
-            # Generate embedding for the cached response using keywords
-            response_embedding, response_keywords = await embedding_service.generate_keyword_embedding(cached_query.response)
 
-            end_time = time.time()
-            response_time_ms = int((end_time - start_time) * 1000)  # Convert to milliseconds
-
-            # Store this query in database even though we're using cached response
-            # Link it to the original cached query
-            db_service.store_query(
-                user_id=user_id,
-                prompt=request.prompt,
-                response=cached_query.response,
-                prompt_embedding=prompt_embedding,
-                response_embedding=response_embedding,
-                cached_query_id=cached_query.id,
+        # Steps 1-3: Look for an exact repeat, else embed the prompt and look
+        # for a very close match in the database
+        cached_query, prompt_embedding, prompt_keywords = await _find_cached_query(request, get_database_service())
+        if cached_query:
+            # Use cached response but still store this query in database,
+            # linked to the original cached query and reusing its response
+            # embedding. Only the keywords are needed for the response;
+            # storing happens after it is sent.
+            response_keywords = await get_embedding_service().extract_keywords(cached_query.response)
+            background_tasks.add_task(
+                _record_query_logged,
+                request, user_id, prompt_embedding, prompt_keywords,
+                response_text=cached_query.response,
                 model_used="cached",
                 tokens_used=0,  # Cached responses use 0 tokens
-                response_time_ms=response_time_ms,  # Cached responses have minimal response time
-                rating=rating,
-                keywords=prompt_keywords  # Use LLM-extracted keywords from prompt
+                response_time_ms=_elapsed_ms(start_time),
+                cached_query_id=cached_query.id,
+                response_embedding=cached_query.response_embedding
             )
 
-            return GenerateResponse(
+            # Built from our own stored row, so it skips validation; FastAPI
+            # passes a response_model instance through as is and pydantic-core
+            # serializes it straight to JSON bytes
+            return GenerateResponse.model_construct(
                 generated_text=cached_query.response,
                 provider=request.provider.value,
                 model_used="cached",
@@ -323,65 +784,41 @@ async def generate(request: GenerateRequest, user_id: str = Depends(verify_api_k
                 similarity_score=cached_query.similarity_score
             )
 
-        # Step 4: No close match found, query the LLM provider
-        llm_response = None
-        match request.provider:
-            case Provider.OPENAI:
-                llm_response = await LLMService.generate_openai(request, user_id)
-            case Provider.ANTHROPIC:
-                llm_response = await LLMService.generate_anthropic(request, user_id)
-            case Provider.XAI:
-                llm_response = await LLMService.generate_xai(request, user_id)
-
-        end_time = time.time()
-        response_time_ms = int((end_time - start_time) * 1000)  # Convert to milliseconds
+        # Step 4: No close match found, query the LLM provider. Identical
+        # deterministic requests already in flight share one upstream call.
+        xai_client = http_request.app.state.xai_client
+        if _is_deterministic(request):
+            llm_response = await _inflight_generations.do(
+                _request_key(request),
+                lambda: _call_provider(request, user_id, xai_client)
+            )
+        else:
+            llm_response = await _call_provider(request, user_id, xai_client)
 
         if llm_response is None:
             raise HTTPException(status_code=500, detail="Failed to generate response")
 
-        # Extract token usage from the response
-        tokens_used = 0
-        if isinstance(llm_response.usage, dict):
-            # For OpenAI and XAI, usage typically has 'total_tokens'
-            tokens_used = llm_response.usage.get('total_tokens', 0)
-            # If total_tokens not available, sum prompt_tokens and completion_tokens
-            if tokens_used == 0:
-                tokens_used = llm_response.usage.get('prompt_tokens', 0) + llm_response.usage.get('completion_tokens', 0)
-            # For Anthropic, usage has 'input_tokens' and 'output_tokens'
-            if tokens_used == 0:
-                tokens_used = llm_response.usage.get('input_tokens', 0) + llm_response.usage.get('output_tokens', 0)
-
-        # Step 5: Generate embedding for the response using keywords
-        response_embedding, response_keywords = await embedding_service.generate_keyword_embedding(llm_response.generated_text)
-
-        # Step 6: Store in database
-        db_service.store_query(
-            user_id=user_id,
-            prompt=request.prompt,
-            response=llm_response.generated_text,
-            prompt_embedding=prompt_embedding,
-            response_embedding=response_embedding,
+        # Step 5: Store in database with the response embedding, after the
+        # response is sent
+        response_keywords = await get_embedding_service().extract_keywords(llm_response.generated_text)
+        background_tasks.add_task(
+            _record_query_logged,
+            request, user_id, prompt_embedding, prompt_keywords,
+            response_text=llm_response.generated_text,
             model_used=llm_response.model_used,
-            tokens_used=tokens_used,
-            response_time_ms=response_time_ms,
-            rating=rating,
-            keywords=prompt_keywords  # Use LLM-extracted keywords from prompt
+            tokens_used=_tokens_used(llm_response.usage),
+            response_time_ms=_elapsed_ms(start_time)
         )
 
-        # Return the fresh response
-        return GenerateResponse(
-            generated_text=llm_response.generated_text,
-            provider=llm_response.provider,
-            model_used=llm_response.model_used,
-            usage={
+        # Return the fresh response; model_copy skips a second validation pass
+        return llm_response.model_copy(update={
+            "usage": {
                 **(llm_response.usage or {}),
                 "prompt_keywords": prompt_keywords,
                 "response_keywords": response_keywords,
             },
-            user_id=llm_response.user_id,
-            cached=False,
-            similarity_score=None
-        )
+            "user_id": user_id,
+        })
 
     except HTTPException:
         raise
@@ -391,6 +828,197 @@ async def generate(request: GenerateRequest, user_id: str = Depends(verify_api_k
             detail=f"Generation failed: {str(e)}"
         )
 
+
+def _sse(data: dict, event: str = None) -> bytes:
+    """Format a server-sent event with a JSON payload."""
+    message = b"data: " + orjson.dumps(data) + b"\n\n"
+    return f"event: {event}\n".encode() + message if event else message
+
+
+async def _coalesce_text(items: AsyncIterator, window: float = 0.05) -> AsyncIterator:
+    """Merge text deltas that arrive within `window` seconds into one chunk.
+
+    Buffered text is sent once the window has passed even if the provider
+    pauses, so no delta is held longer than `window`.
+    """
+    iterator = items.__aiter__()
+    buffer = []
+    last_flush = time.monotonic()
+    # The pending read is a task so a timed-out wait doesn't cancel the provider stream
+    next_item = None
+    try:
+        while True:
+            if next_item is None:
+                next_item = asyncio.ensure_future(iterator.__anext__())
+            if buffer:
+                remaining = window - (time.monotonic() - last_flush)
+                done, _ = await asyncio.wait({next_item}, timeout=max(remaining, 0))
+                if not done:
+                    yield "".join(buffer)
+                    buffer = []
+                    last_flush = time.monotonic()
+                    continue
+            try:
+                item = await next_item
+            except StopAsyncIteration:
+                break
+            next_item = None
+
+            if isinstance(item, str):
+                buffer.append(item)
+                if time.monotonic() - last_flush < window:
+                    continue
+            if buffer:
+                yield "".join(buffer)
+                buffer = []
+                last_flush = time.monotonic()
+            if not isinstance(item, str):
+                yield item
+    finally:
+        # Close the provider stream now rather than at garbage collection, so
+        # its upstream connection and the caller's provider slot are released
+        if next_item is not None and not next_item.done():
+            next_item.cancel()
+            await asyncio.wait({next_item})
+        if next_item is not None and not next_item.cancelled():
+            next_item.exception()
+        await iterator.aclose()
+    if buffer:
+        yield "".join(buffer)
+
+
+@app.post("/api/generate/stream")
+async def generate_stream(
+    request: GenerateRequest,
+    http_request: Request,
+    background_tasks: BackgroundTasks,
+    user_id: str = Depends(verify_api_key)
+):
+    """
+    Generate text like /api/generate, streaming it back as server-sent events.
+
+    Text is sent as `data: {"text": ...}` events as the provider produces it,
+    followed by a `done` event with the same metadata /api/generate returns
+    (minus the text and response keywords). The query is stored after the
+    stream has ended.
+    Provider errors after the stream has started are sent as an `error` event.
+
+    Args:
+        request: Generation request with prompt, provider, and parameters
+        http_request: Incoming HTTP request, for the app's shared clients
+        background_tasks: Tasks run after the stream ends, for storage
+        user_id: Authenticated user ID from API key
+    Returns:
+        text/event-stream response
+
+    Raises:
+        HTTPException: If the prompt embedding or cache lookup fails
+    """
+    _check_context_window(request)
+    start_time = time.time()
+    try:
+        cached_query, prompt_embedding, prompt_keywords = await _find_cached_query(request, get_database_service())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
+
+    async def events():
+        if cached_query:
+            yield _sse({"text": cached_query.response})
+            yield _sse({
+                "provider": request.provider.value,
+                "model_used": "cached",
+                "usage": {"cached": True, "prompt_keywords": prompt_keywords},
+                "user_id": user_id,
+                "cached": True,
+                "similarity_score": cached_query.similarity_score
+            }, event="done")
+            response_text, model_used, tokens_used = cached_query.response, "cached", 0
+        else:
+            chunks = _STREAM[request.provider](request, user_id, http_request.app.state.xai_client)
+
+            llm_response = None
+            try:
+                # The provider slot is held for the whole stream
+                async with _PROVIDER_LIMITS[request.provider]:
+                    async with aclosing(_coalesce_text(chunks)) as items:
+                        async for item in items:
+                            if isinstance(item, str):
+                                yield _sse({"text": item})
+                            else:
+                                llm_response = item
+            except HTTPException as e:
+                yield _sse({"status_code": e.status_code, "detail": e.detail}, event="error")
+                return
+            except Exception as e:
+                yield _sse({"status_code": 400, "detail": f"{request.provider.value} API error: {str(e)}"}, event="error")
+                return
+
+            yield _sse({
+                **llm_response.model_dump(exclude={"generated_text"}),
+                "usage": {**llm_response.usage, "prompt_keywords": prompt_keywords}
+            }, event="done")
+            response_text = llm_response.generated_text
+            model_used = llm_response.model_used
+            tokens_used = _tokens_used(llm_response.usage)
+
+        # Stored once the response is complete, so the stream closes without
+        # waiting for the response embedding and insert
+        background_tasks.add_task(
+            _record_query_logged,
+            request, user_id, prompt_embedding, prompt_keywords,
+            response_text=response_text,
+            model_used=model_used,
+            tokens_used=tokens_used,
+            response_time_ms=_elapsed_ms(start_time),
+            cached_query_id=cached_query.id if cached_query else None,
+            response_embedding=cached_query.response_embedding if cached_query else None
+        )
+
+    return StreamingResponse(events(), media_type="text/event-stream", background=background_tasks)
+
+
+@app.post("/api/similar")
+async def similar(request: SimilarRequest, user_id: str = Depends(verify_api_key)):
+    """
+    Stream the user's past queries that are similar to a prompt.
+
+    Results are sent as newline-delimited JSON, one query per line, in order of
+    decreasing similarity, so clients can render them as they arrive.
+
+    Args:
+        request: Search request with prompt, threshold and result limit
+        user_id: Authenticated user ID from API key
+    Returns:
+        NDJSON stream of similar queries
+
+    Raises:
+        HTTPException: If the prompt embedding fails
+    """
+    try:
+        prompt_embedding, _ = await get_embedding_service().generate_keyword_embedding(request.prompt)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Embedding failed: {str(e)}")
+
+    async def stream_matches():
+        async for query in get_database_service().iter_similar_queries(
+            prompt_embedding=prompt_embedding,
+            similarity_threshold=request.similarity_threshold,
+            max_results=request.max_results,
+            user_id=user_id
+        ):
+            yield orjson.dumps(query) + b"\n"
+
+    return StreamingResponse(stream_matches(), media_type="application/x-ndjson")
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop/httptools ship with uvicorn[standard]; multiple workers need an import string
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count())),
+        log_level=os.getenv("LOG_LEVEL", "info")
+    )
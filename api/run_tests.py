@@ -24,12 +24,12 @@ def show_help():
         },
         {
             "name": "Database Tests",
-            "cmd": ["uv", "run", "python", "-m", "pytest", "test_files/test_database.py", "-v", "-s"],
+            "cmd": ["uv", "run", "python", "-m", "pytest", "test_files/test_database.py", "-v", "--log-cli-level=DEBUG"],
             "description": "Run database service tests only"
         },
         {
             "name": "Embedding Tests",
-            "cmd": ["uv", "run", "python", "-m", "pytest", "test_files/test_embedding.py", "-v", "-s"],
+            "cmd": ["uv", "run", "python", "-m", "pytest", "test_files/test_embedding.py", "-v", "--log-cli-level=DEBUG"],
             "description": "Run embedding service tests only"
         },
         {
@@ -44,7 +44,7 @@ def show_help():
         },
         {
             "name": "Real API Integration",
-            "cmd": ["uv", "run", "python", "-m", "pytest", "test_files/test_generate_endpoint.py::TestGenerateEndpoint::test_real_openai_integration", "-v", "-s"],
+            "cmd": ["uv", "run", "python", "-m", "pytest", "test_files/test_generate_endpoint.py::TestGenerateEndpoint::test_real_openai_integration", "-m", "integration", "-v", "--log-cli-level=DEBUG"],
             "description": "Run only the real API integration test"
         }
     ]
@@ -62,8 +62,8 @@ def show_help():
     print("\nManual commands:")
     print("• All Tests: uv run python -m pytest test_files/ -v")
     print("• API Endpoint: uv run python -m pytest test_files/test_generate_endpoint.py -v")
-    print("• Database: uv run python -m pytest test_files/test_database.py -v -s")
-    print("• Embeddings: uv run python -m pytest test_files/test_embedding.py -v -s")
+    print("• Database: uv run python -m pytest test_files/test_database.py -v --log-cli-level=DEBUG")
+    print("• Embeddings: uv run python -m pytest test_files/test_embedding.py -v --log-cli-level=DEBUG")
 
     print("\n✅ Test suite is ready!")
     print("📁 Test files location: test_files/")
@@ -82,11 +82,11 @@ def run_tests(test_type="all"):
     commands = {
         "all": ["uv", "run", "python", "-m", "pytest", "test_files/", "-v"],
         "api": ["uv", "run", "python", "-m", "pytest", "test_files/test_generate_endpoint.py", "-v"],
-        "db": ["uv", "run", "python", "-m", "pytest", "test_files/test_database.py", "-v", "-s"],
-        "embedding": ["uv", "run", "python", "-m", "pytest", "test_files/test_embedding.py", "-v", "-s"],
+        "db": ["uv", "run", "python", "-m", "pytest", "test_files/test_database.py", "-v", "--log-cli-level=DEBUG"],
+        "embedding": ["uv", "run", "python", "-m", "pytest", "test_files/test_embedding.py", "-v", "--log-cli-level=DEBUG"],
         "coverage": ["uv", "run", "python", "-m", "pytest", "test_files/", "--cov=.", "--cov-report=term-missing"],
         "quick": ["uv", "run", "python", "-m", "pytest", "test_files/", "-x", "-q"],
-        "integration": ["uv", "run", "python", "-m", "pytest", "test_files/test_generate_endpoint.py::TestGenerateEndpoint::test_real_openai_integration", "-v", "-s"]
+        "integration": ["uv", "run", "python", "-m", "pytest", "test_files/test_generate_endpoint.py::TestGenerateEndpoint::test_real_openai_integration", "-m", "integration", "-v", "--log-cli-level=DEBUG"]
     }
 
     if test_type not in commands:
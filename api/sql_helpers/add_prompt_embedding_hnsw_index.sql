@@ -0,0 +1,18 @@
+-- Migration to add an HNSW index on queries.prompt_embedding
+-- Run this in your Supabase SQL Editor
+
+-- Give the index build enough memory and workers to finish quickly
+set max_parallel_maintenance_workers = 7;
+set maintenance_work_mem = '2GB';
+
+-- HNSW index for cosine distance so match_queries uses an Index Scan
+-- instead of a Seq Scan + top-N sort over every stored embedding
+create index if not exists queries_prompt_embedding_hnsw
+  on queries using hnsw (prompt_embedding vector_cosine_ops)
+  with (m = 24, ef_construction = 128);
+
+reset maintenance_work_mem;
+reset max_parallel_maintenance_workers;
+
+-- Verify the planner picks the index (expect "Index Scan using queries_prompt_embedding_hnsw"):
+-- EXPLAIN SELECT id FROM queries ORDER BY prompt_embedding <=> '[...]'::vector LIMIT 5;
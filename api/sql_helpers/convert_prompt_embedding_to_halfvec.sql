@@ -0,0 +1,26 @@
+-- Migration to store prompt embeddings at half precision (requires pgvector 0.7+)
+-- Run this in your Supabase SQL Editor
+--
+-- halfvec uses 2 bytes per dimension instead of 4, halving table and HNSW index
+-- size (and memory bandwidth during index traversal) with negligible recall loss.
+-- Inserts need no client changes: PostgREST casts the JSON array on write.
+
+-- The float32 index cannot be reused for the new type
+drop index if exists queries_prompt_embedding_hnsw;
+
+alter table queries
+alter column prompt_embedding type halfvec(1536) using prompt_embedding::halfvec(1536);
+
+set max_parallel_maintenance_workers = 7;
+set maintenance_work_mem = '2GB';
+
+create index if not exists queries_prompt_embedding_hnsw
+  on queries using hnsw (prompt_embedding halfvec_cosine_ops)
+  with (m = 24, ef_construction = 128);
+
+reset maintenance_work_mem;
+reset max_parallel_maintenance_workers;
+
+-- Drop the float32 overload so PostgREST resolves match_queries unambiguously,
+-- then re-run match_queries.sql to create the halfvec version
+drop function if exists match_queries(vector, float, int);
@@ -0,0 +1,11 @@
+-- Migration to store response embeddings at half precision (requires pgvector 0.7+)
+-- Run this in your Supabase SQL Editor, after resize_embeddings_to_512.sql
+--
+-- Prompt embeddings are already halfvec. Response embeddings are not indexed,
+-- but every row stores one and cache hits now read it back to reuse it, so
+-- halving it shrinks the table and the cache-hit fetch. Inserts need no client
+-- changes: PostgREST casts the JSON array on write.
+
+alter table queries
+alter column response_embedding type halfvec(512)
+  using response_embedding::halfvec(512);
@@ -0,0 +1,42 @@
+-- SQL function returning the plan of the similarity search in match_queries
+-- Run this in your Supabase SQL Editor
+--
+-- EXPLAIN on the RPC itself only shows a Function Scan, so this explains the
+-- inner nearest-neighbour query of match_queries directly, with the same
+-- settings and optional user filter. The integration tests call it to check
+-- the search is served by the HNSW index rather than a sequential scan. The
+-- planner is left free to choose, so on a table too small for the index to
+-- pay off the plan honestly shows a sequential scan.
+-- Keep the query in step with match_queries.sql.
+
+-- Replaces the plan helper for the removed match_query_ids function
+DROP FUNCTION IF EXISTS explain_match_query_ids(halfvec, int);
+
+CREATE OR REPLACE FUNCTION explain_match_queries(
+  query_embedding halfvec(512),
+  match_count int DEFAULT 5,
+  ef_search int DEFAULT 100,
+  filter_user_id uuid DEFAULT NULL
+)
+RETURNS SETOF text
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  PERFORM set_config('hnsw.ef_search', ef_search::text, true);
+  IF filter_user_id IS NOT NULL THEN
+    PERFORM set_config('hnsw.iterative_scan', 'strict_order', true);
+  END IF;
+
+  RETURN QUERY EXECUTE
+    'EXPLAIN SELECT q.id, q.user_id, q.prompt, q.response, q.response_embedding,
+            -(q.prompt_embedding <#> $1) AS similarity
+     FROM queries q
+     WHERE $3::uuid IS NULL OR q.user_id = $3
+     ORDER BY q.prompt_embedding <#> $1
+     LIMIT $2'
+    USING query_embedding, match_count, filter_user_id;
+END;
+$$;
+
+-- Query plans are for maintainers only; the service role key can still call it
+REVOKE EXECUTE ON FUNCTION explain_match_queries(halfvec, int, int, uuid) FROM PUBLIC, anon, authenticated;
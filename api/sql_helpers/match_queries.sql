@@ -1,28 +1,80 @@
 -- SQL function for vector similarity search
 -- Run this in your Supabase SQL Editor
+--
+-- The inner query only orders by distance and limits, which lets the planner
+-- use the HNSW index on prompt_embedding (see add_prompt_embedding_hnsw_index.sql
+-- and convert_prompt_embedding_to_halfvec.sql).
+-- The similarity threshold is applied afterwards in the outer query; filtering
+-- before the ORDER BY would force an exact scan. hnsw.ef_search defaults to
+-- 100 rather than pgvector's 40 for better recall at a small latency cost;
+-- callers can pass ef_search to trade recall for latency per query.
+-- filter_user_id restricts the search to one user's queries. An HNSW scan
+-- applies such a filter only to the ef_search candidates it collected, so a
+-- user with few rows would get fewer than match_count (often none). With the
+-- filter set, hnsw.iterative_scan (pgvector 0.8+) makes the index scan keep
+-- going, in exact distance order, until match_count of the user's rows are
+-- found or hnsw.max_scan_tuples (default 20000) is reached.
+-- with_response_embedding also returns each row's response_embedding, for the
+-- generate cache lookup that reuses it; other callers leave it NULL.
+-- Embeddings are stored L2-normalized, so cosine similarity is the plain inner
+-- product (<#> returns its negation); see use_inner_product_index.sql.
+
+-- Replace the older versions so PostgREST resolves it unambiguously
+DROP FUNCTION IF EXISTS match_queries(halfvec, float, int);
+DROP FUNCTION IF EXISTS match_queries(halfvec, float, int, int);
+DROP FUNCTION IF EXISTS match_queries(halfvec, float, int, int, uuid);
+-- The ids-only first pass is no longer used; the cache lookup is one call here
+DROP FUNCTION IF EXISTS match_query_ids(halfvec, float, int);
+-- Nothing searches several prompts at once, so the batched variant is gone too
+DROP FUNCTION IF EXISTS match_queries_batch(jsonb, float, int, int);
 
 CREATE OR REPLACE FUNCTION match_queries(
-  query_embedding vector(1536),
+  query_embedding halfvec(512),
   match_threshold float DEFAULT 0.7,
-  match_count int DEFAULT 5
+  match_count int DEFAULT 5,
+  ef_search int DEFAULT 100,
+  filter_user_id uuid DEFAULT NULL,
+  with_response_embedding boolean DEFAULT false
 )
 RETURNS TABLE (
   id uuid,
   user_id uuid,
   prompt text,
   response text,
-  similarity float
+  similarity float,
+  response_embedding halfvec(512)
 )
-LANGUAGE sql
+LANGUAGE plpgsql
 AS $$
+BEGIN
+  -- Local to the request's transaction
+  PERFORM set_config('hnsw.ef_search', ef_search::text, true);
+  IF filter_user_id IS NOT NULL THEN
+    PERFORM set_config('hnsw.iterative_scan', 'strict_order', true);
+  END IF;
+
+  RETURN QUERY
   SELECT
-    q.id,
-    q.user_id,
-    q.prompt,
-    q.response,
-    1 - (q.prompt_embedding <=> query_embedding) AS similarity
-  FROM queries q
-  WHERE 1 - (q.prompt_embedding <=> query_embedding) >= match_threshold
-  ORDER BY q.prompt_embedding <=> query_embedding
-  LIMIT match_count;
+    nearest.id,
+    nearest.user_id,
+    nearest.prompt,
+    nearest.response,
+    nearest.similarity,
+    CASE WHEN with_response_embedding THEN nearest.response_embedding END
+  FROM (
+    SELECT
+      q.id,
+      q.user_id,
+      q.prompt,
+      q.response,
+      q.response_embedding,
+      -(q.prompt_embedding <#> query_embedding) AS similarity
+    FROM queries q
+    WHERE filter_user_id IS NULL OR q.user_id = filter_user_id
+    ORDER BY q.prompt_embedding <#> query_embedding
+    LIMIT match_count
+  ) nearest
+  WHERE nearest.similarity >= match_threshold
+  ORDER BY nearest.similarity DESC;
+END;
 $$;
@@ -0,0 +1,29 @@
+-- Migration to shrink stored embeddings from 1536 to 512 dimensions
+-- Run this in your Supabase SQL Editor (requires pgvector 0.7+)
+--
+-- text-embedding-3-small supports shortened embeddings: the first N components,
+-- re-normalized, are what the API returns for dimensions=N. Existing rows can
+-- therefore be converted in place without calling OpenAI again. Smaller vectors
+-- mean 3x less storage and 3x cheaper distance computations in the HNSW index.
+
+drop index if exists queries_prompt_embedding_hnsw;
+
+alter table queries
+alter column prompt_embedding type halfvec(512)
+  using l2_normalize(subvector(prompt_embedding, 1, 512));
+
+alter table queries
+alter column response_embedding type vector(512)
+  using l2_normalize(subvector(response_embedding, 1, 512));
+
+set max_parallel_maintenance_workers = 7;
+set maintenance_work_mem = '2GB';
+
+create index if not exists queries_prompt_embedding_hnsw
+  on queries using hnsw (prompt_embedding halfvec_cosine_ops)
+  with (m = 24, ef_construction = 128);
+
+reset maintenance_work_mem;
+reset max_parallel_maintenance_workers;
+
+-- Re-run match_queries.sql afterwards so it takes a halfvec(512) argument
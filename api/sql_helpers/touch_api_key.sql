@@ -0,0 +1,21 @@
+-- SQL function to resolve an API key to its owner and record its use
+-- Run this in your Supabase SQL Editor
+--
+-- Looking the key up and setting last_used_at in one UPDATE ... RETURNING
+-- takes one round trip instead of a SELECT followed by a separate UPDATE.
+-- Returns NULL for unknown or inactive keys.
+
+CREATE OR REPLACE FUNCTION touch_api_key(token text)
+RETURNS uuid
+LANGUAGE sql
+AS $$
+  UPDATE user_api_keys
+  SET last_used_at = now()
+  WHERE api_key = token AND is_active
+  RETURNING user_id;
+$$;
+
+-- Only the API's service role may resolve keys; with the public anon key
+-- anyone could otherwise probe whether a pl_ token is valid
+REVOKE EXECUTE ON FUNCTION touch_api_key(text) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION touch_api_key(text) TO service_role;
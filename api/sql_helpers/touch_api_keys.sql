@@ -0,0 +1,20 @@
+-- SQL function to record API key usage with a server-side timestamp
+-- Run this in your Supabase SQL Editor
+--
+-- Setting last_used_at with now() in the database means the API no longer
+-- builds and ships an ISO timestamp string on every authenticated request.
+-- Takes an array so several keys can be touched in one call.
+
+CREATE OR REPLACE FUNCTION touch_api_keys(tokens text[])
+RETURNS void
+LANGUAGE sql
+AS $$
+  UPDATE user_api_keys
+  SET last_used_at = now()
+  WHERE api_key = ANY(tokens);
+$$;
+
+-- Only the API's service role may record usage; with the public anon key
+-- anyone could otherwise rewrite last_used_at
+REVOKE EXECUTE ON FUNCTION touch_api_keys(text[]) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION touch_api_keys(text[]) TO service_role;
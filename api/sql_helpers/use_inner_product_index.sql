@@ -0,0 +1,25 @@
+-- Migration to search prompt embeddings by inner product instead of cosine
+-- Run this in your Supabase SQL Editor (requires pgvector 0.7+)
+--
+-- For unit-length vectors cosine similarity equals the dot product, so the
+-- per-comparison norm computations in <=> are wasted work. The API now
+-- L2-normalizes embeddings before storing and searching; this normalizes the
+-- existing rows and rebuilds the HNSW index for the <#> operator.
+
+update queries
+set prompt_embedding = l2_normalize(prompt_embedding)
+where prompt_embedding is not null;
+
+drop index if exists queries_prompt_embedding_hnsw;
+
+set max_parallel_maintenance_workers = 7;
+set maintenance_work_mem = '2GB';
+
+create index if not exists queries_prompt_embedding_hnsw
+  on queries using hnsw (prompt_embedding halfvec_ip_ops)
+  with (m = 24, ef_construction = 128);
+
+reset maintenance_work_mem;
+reset max_parallel_maintenance_workers;
+
+-- Re-run match_queries.sql afterwards so it orders by <#>
@@ -0,0 +1,41 @@
+"""Shared pytest fixtures."""
+
+import uuid
+import httpx
+import pytest
+import pytest_asyncio
+from fastapi.testclient import TestClient
+from main import app
+
+
+@pytest.fixture(scope="session")
+def client():
+    """Test client for the app, running its lifespan once for the whole session.
+
+    A warmup request is sent first, so the first test isn't charged for the app's lazy setup.
+    """
+    with TestClient(app) as test_client:
+        test_client.get("/health")
+        yield test_client
+
+
+@pytest_asyncio.fixture
+async def async_client():
+    """Async client calling the app in-process, so requests can be awaited concurrently."""
+    # ASGITransport doesn't send lifespan events, so run the lifespan here
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as test_client:
+            yield test_client
+
+
+@pytest.fixture(scope="session")
+def fake_user_id():
+    """User ID for queries stored by the integration tests, distinct per xdist worker."""
+    return str(uuid.uuid4())
+
+
+@pytest.fixture(scope="session")
+def fake_embeddings():
+    """Prompt and response embeddings for queries stored by the integration tests."""
+    return [0.1] * 512, [0.2] * 512
@@ -0,0 +1,146 @@
+"""Simple pytest tests for the caching helpers."""
+
+import pytest
+import logging
+import asyncio
+from cache import AsyncTTLCache, SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class TestSingleFlight:
+    """Simple test suite for in-flight call coalescing."""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_calls_share_one_computation(self):
+        """Test that concurrent callers with the same key share a single call."""
+        flight = SingleFlight()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+
+        results = await asyncio.gather(*(flight.do("key", compute) for _ in range(5)))
+
+        assert results == ["result"] * 5
+        assert len(calls) == 1
+        logger.debug("✅ Concurrent calls coalesced into one")
+
+    @pytest.mark.asyncio
+    async def test_finished_calls_are_not_retained(self):
+        """Test that a finished call is not reused by later callers."""
+        flight = SingleFlight()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            return len(calls)
+
+        assert await flight.do("key", compute) == 1
+        assert await flight.do("key", compute) == 2
+
+    @pytest.mark.asyncio
+    async def test_failure_is_shared_and_not_retained(self):
+        """Test that concurrent callers all see a failure and the next call retries."""
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("upstream error")
+
+        results = await asyncio.gather(flight.do("key", fail), flight.do("key", fail), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+
+        async def succeed():
+            return "ok"
+
+        assert await flight.do("key", succeed) == "ok"
+
+    @pytest.mark.asyncio
+    async def test_cancelled_leader_does_not_cancel_followers(self):
+        """Test that cancelling the first caller leaves the shared call running for the others."""
+        flight = SingleFlight()
+        started = asyncio.Event()
+
+        async def compute():
+            started.set()
+            await asyncio.sleep(0.01)
+            return "result"
+
+        leader = asyncio.create_task(flight.do("key", compute))
+        await started.wait()
+        follower = asyncio.create_task(flight.do("key", compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+
+        assert await follower == "result"
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+
+
+class TestAsyncTTLCache:
+    """Simple test suite for the coalescing TTL cache."""
+
+    @pytest.mark.asyncio
+    async def test_cancelled_leader_still_caches_result(self):
+        """Test that cancelling the caller that missed doesn't fail waiters or drop the entry."""
+        cache = AsyncTTLCache(maxsize=10, ttl=60)
+        started = asyncio.Event()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            started.set()
+            await asyncio.sleep(0.01)
+            return "value"
+
+        leader = asyncio.create_task(cache.get_or_compute("key", compute))
+        await started.wait()
+        follower = asyncio.create_task(cache.get_or_compute("key", compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+
+        assert await follower == "value"
+        assert await cache.get_or_compute("key", compute) == "value"
+        assert len(calls) == 1
+
+    @pytest.mark.asyncio
+    async def test_computation_is_cancelled_without_waiters(self):
+        """Test that the shared computation stops once its only caller is cancelled."""
+        cache = AsyncTTLCache(maxsize=10, ttl=60)
+        started = asyncio.Event()
+        cancelled = []
+
+        async def compute():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+
+        caller = asyncio.create_task(cache.get_or_compute("key", compute))
+        await started.wait()
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await asyncio.sleep(0)
+
+        assert cancelled == [1]
+
+    @pytest.mark.asyncio
+    async def test_failure_is_not_cached(self):
+        """Test that a failed computation is retried by the next caller."""
+        cache = AsyncTTLCache(maxsize=10, ttl=60)
+
+        async def fail():
+            raise ValueError("upstream error")
+
+        async def succeed():
+            return "value"
+
+        with pytest.raises(ValueError):
+            await cache.get_or_compute("key", fail)
+        assert await cache.get_or_compute("key", succeed) == "value"
@@ -1,15 +1,51 @@
 """Simple pytest tests for the database service."""
 
 import pytest
+import logging
+import math
+import struct
 import uuid
 import os
 import random
+import httpx
+from types import SimpleNamespace
 from dotenv import load_dotenv
-from database import get_database_service
+import database
+from database import DatabaseService, get_database_service, normalize_embedding, _execute_with_retry
 
 # Load environment variables
 load_dotenv()
 
+# Credentials for the integration tests, read once at import
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_API = os.getenv("SUPABASE_API")
+
+logger = logging.getLogger(__name__)
+
+
+class FakeSupabase:
+    """Stand-in for the Supabase client that records match_queries calls.
+
+    Rows are filtered by user before the limit, which is what the real function
+    relies on hnsw.iterative_scan for; test_user_filter_finds_own_rows checks
+    that part against the database.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    def rpc(self, fn, params):
+        self.calls.append(params)
+        return self
+
+    async def execute(self):
+        # Like the SQL function: filter by user, then keep the top match_count
+        params = self.calls[-1]
+        user_id = params.get('filter_user_id')
+        rows = [row for row in self.rows if user_id is None or row['user_id'] == user_id]
+        return SimpleNamespace(data=rows[:params['match_count']])
+
 
 class TestDatabaseService:
     """Simple test suite for the database service."""
@@ -23,24 +59,115 @@ class TestDatabaseService:
         """Test that database service can be created."""
         db = get_database_service()
         assert db is not None
-        print("✅ Database service created successfully")
+        logger.debug("✅ Database service created successfully")
+
+    def test_database_service_is_singleton(self, monkeypatch):
+        """Test that the database service, and its connection pool, is built once per process."""
+        built = []
+
+        class CountingService:
+            def __init__(self):
+                built.append(self)
+
+        monkeypatch.setattr(database, "_db_service", None)
+        monkeypatch.setattr(database, "DatabaseService", CountingService)
+
+        assert database.get_database_service() is database.get_database_service()
+        assert len(built) == 1
+
+    def test_normalize_embedding(self):
+        """Test that embeddings are scaled to unit length before storage and search."""
+        normalized = normalize_embedding([3.0, 4.0])
+        assert normalized == pytest.approx([0.6, 0.8])
+        assert normalize_embedding([0.0, 0.0]) == [0.0, 0.0]
+
+    @pytest.mark.asyncio
+    async def test_store_queries_inserts_in_batches(self):
+        """Test that many queries are stored with one insert per batch, IDs in input order."""
+        inserts = []
+
+        class FakeTable:
+            def insert(self, rows, default_to_null=True):
+                inserts.append(rows)
+                return self
+
+            async def execute(self):
+                start = sum(len(rows) for rows in inserts[:-1])
+                return SimpleNamespace(data=[{'id': str(start + i)} for i in range(len(inserts[-1]))])
+
+        db = DatabaseService.__new__(DatabaseService)
+        db.supabase = SimpleNamespace(table=lambda name: FakeTable())
+        queries = [
+            {'user_id': 'user', 'prompt': 'p', 'response': 'r',
+             'prompt_embedding': [1.0, 0.0], 'response_embedding': [0.0, 1.0]}
+            for _ in range(5)
+        ]
+
+        query_ids = await db.store_queries(queries, batch_size=2)
+
+        assert [len(rows) for rows in inserts] == [2, 2, 1]
+        assert query_ids == ['0', '1', '2', '3', '4']
+
+    def test_half_precision_keeps_similarity_above_cache_threshold(self):
+        """Test that rounding embeddings to float16, as halfvec storage does, barely moves similarity."""
+        embedding = normalize_embedding([math.sin(i) for i in range(512)])
+        halved = list(struct.unpack(f"{len(embedding)}e", struct.pack(f"{len(embedding)}e", *embedding)))
+
+        similarity = sum(a * b for a, b in zip(embedding, halved))
+        assert similarity == pytest.approx(1.0, abs=1e-4)
+        assert similarity > 0.95
+
+    @pytest.mark.asyncio
+    async def test_transient_connect_error_is_retried(self):
+        """Test that read queries are retried after a transient connection failure."""
+        class FlakyQuery:
+            calls = 0
+
+            async def execute(self):
+                FlakyQuery.calls += 1
+                if FlakyQuery.calls == 1:
+                    raise httpx.ConnectError("connection refused")
+                return "ok"
 
-    @pytest.mark.skipif(not os.getenv("SUPABASE_URL") or not os.getenv("SUPABASE_API"),
+        assert await _execute_with_retry(FlakyQuery()) == "ok"
+        assert FlakyQuery.calls == 2
+
+    @pytest.mark.asyncio
+    async def test_iter_similar_queries_filters_by_user_before_limit(self):
+        """Test that the user filter is passed to match_queries in a single call."""
+        rows = [
+            {'id': str(i), 'user_id': 'other' if i < 10 else 'user', 'prompt': 'p', 'response': 'r',
+             'similarity': 1 - i / 100}
+            for i in range(25)
+        ]
+        db = DatabaseService.__new__(DatabaseService)
+        db.supabase = FakeSupabase(rows)
+
+        results = [
+            query async for query in db.iter_similar_queries([1.0, 0.0], max_results=5, user_id='user')
+        ]
+
+        assert [query.id for query in results] == ['10', '11', '12', '13', '14']
+        assert db.supabase.calls[0]['filter_user_id'] == 'user'
+        # One search, not one per page
+        assert len(db.supabase.calls) == 1
+
+    @pytest.mark.skipif(not SUPABASE_URL or not SUPABASE_API,
                        reason="Supabase credentials not set")
-    def test_store_and_find_query(self, db_service):
+    @pytest.mark.asyncio
+    async def test_store_and_find_query(self, db_service, fake_user_id, fake_embeddings):
         """Test storing a query and finding it with similarity search."""
         # Test data
-        user_id = str(uuid.uuid4())
+        user_id = fake_user_id
         prompt = "What is machine learning?"
         response = "Machine learning is a subset of AI..."
-        prompt_embedding = [0.1] * 1536
-        response_embedding = [0.2] * 1536
+        prompt_embedding, response_embedding = fake_embeddings
         model_used = "test"
         tokens_used = 100
         response_time_ms = 100
 
         # Store a query in real database
-        query_id = db_service.store_query(
+        query_id = await db_service.store_query(
             user_id=user_id,
             prompt=prompt,
             response=response,
@@ -54,20 +181,143 @@ class TestDatabaseService:
 
         # Verify we got an ID back
         assert query_id is not None
-        print(f"✅ Stored query: {query_id}")
+        logger.debug("✅ Stored query: %s", query_id)
 
-        # Search for similar queries using the same embedding
-        similar = db_service.find_similar_queries(
-            prompt_embedding=prompt_embedding,
-            similarity_threshold=0.5,
-            max_results=3
-        )
+        try:
+            # Search for similar queries using the same embedding
+            similar = await db_service.find_similar_queries(
+                prompt_embedding=prompt_embedding,
+                similarity_threshold=0.5,
+                max_results=3
+            )
+
+            # Should find at least the query we just stored
+            assert len(similar) >= 1
+            assert similar[0].similarity_score > 0.9
+
+            logger.debug("✅ Found %d similar queries", len(similar))
+        finally:
+            await db_service.supabase.table('queries').delete().eq('id', query_id).execute()
+
+    @pytest.mark.skipif(not SUPABASE_URL or not SUPABASE_API,
+                       reason="Supabase credentials not set")
+    @pytest.mark.asyncio
+    async def test_user_filter_finds_own_rows(self, db_service):
+        """Test that a user with few rows gets them all, even below other users' closer matches."""
+        user_id = str(uuid.uuid4())
+        rng = random.Random(2)
+        embeddings = [[rng.gauss(0, 1) for _ in range(512)] for _ in range(3)]
+        queries = [
+            {
+                'user_id': user_id,
+                'prompt': f"Filter prompt {i}",
+                'response': f"Filter response {i}",
+                'prompt_embedding': embedding,
+                'response_embedding': normalize_embedding(embedding),
+                'model_used': "test"
+            }
+            for i, embedding in enumerate(embeddings)
+        ]
 
-        # Should find at least the query we just stored
-        assert len(similar) >= 1
-        assert similar[0].similarity_score > 0.9
+        try:
+            query_ids = await db_service.store_queries(queries)
+            # Random vectors are nearly orthogonal, so other users' rows rank
+            # alongside the user's; a threshold of -1 keeps every match
+            results = [
+                query async for query in db_service.iter_similar_queries(
+                    embeddings[0], similarity_threshold=-1.0, max_results=5, user_id=user_id
+                )
+            ]
+            assert sorted(query.id for query in results) == sorted(query_ids)
+            assert results[0].id == query_ids[0]
+        finally:
+            await db_service.supabase.table('queries').delete().eq('user_id', user_id).execute()
+
+    @pytest.mark.skipif(not SUPABASE_URL or not SUPABASE_API,
+                       reason="Supabase credentials not set")
+    @pytest.mark.asyncio
+    async def test_store_queries_batch_then_search(self, db_service):
+        """Test seeding many queries in batched inserts and searching among them."""
+        user_id = str(uuid.uuid4())
+        rng = random.Random(0)
+        embeddings = [[rng.gauss(0, 1) for _ in range(512)] for _ in range(1000)]
+        queries = [
+            {
+                'user_id': user_id,
+                'prompt': f"Seeded prompt {i}",
+                'response': f"Seeded response {i}",
+                'prompt_embedding': embedding,
+                'response_embedding': normalize_embedding(embedding),
+                'model_used': "test"
+            }
+            for i, embedding in enumerate(embeddings)
+        ]
+
+        try:
+            query_ids = await db_service.store_queries(queries)
+            assert len(query_ids) == len(queries)
+
+            # A seeded embedding finds its own row first
+            similar = await db_service.find_similar_queries(
+                prompt_embedding=embeddings[42],
+                similarity_threshold=0.5,
+                max_results=3
+            )
+            assert similar[0].id == query_ids[42]
+            logger.debug("✅ Seeded %d queries and found the nearest", len(query_ids))
+        finally:
+            await db_service.supabase.table('queries').delete().eq('user_id', user_id).execute()
+
+    @pytest.mark.skipif(not SUPABASE_URL or not SUPABASE_API,
+                       reason="Supabase credentials not set")
+    @pytest.mark.asyncio
+    async def test_high_ef_search_recalls_seeded_queries(self, db_service):
+        """Test that a wide HNSW search finds each seeded query from its own embedding."""
+        user_id = str(uuid.uuid4())
+        rng = random.Random(1)
+        embeddings = [[rng.gauss(0, 1) for _ in range(512)] for _ in range(100)]
+        queries = [
+            {
+                'user_id': user_id,
+                'prompt': f"Recall prompt {i}",
+                'response': f"Recall response {i}",
+                'prompt_embedding': embedding,
+                'response_embedding': normalize_embedding(embedding),
+                'model_used': "test"
+            }
+            for i, embedding in enumerate(embeddings)
+        ]
+
+        try:
+            query_ids = await db_service.store_queries(queries)
+            for i in range(0, len(embeddings), 10):
+                similar = await db_service.find_similar_queries(
+                    prompt_embedding=embeddings[i],
+                    similarity_threshold=0.99,
+                    max_results=1,
+                    ef_search=200
+                )
+                assert [query.id for query in similar] == [query_ids[i]]
+            logger.debug("✅ ef_search 200 recalled every sampled seeded query")
+        finally:
+            await db_service.supabase.table('queries').delete().eq('user_id', user_id).execute()
+
+    @pytest.mark.skipif(not SUPABASE_URL or not SUPABASE_API,
+                       reason="Supabase credentials not set")
+    @pytest.mark.asyncio
+    async def test_similarity_search_uses_hnsw_index(self, db_service, fake_user_id, fake_embeddings):
+        """Test that match_queries' search, with and without the user filter, is planned as an HNSW index scan."""
+        prompt_embedding, _ = fake_embeddings
+        for filter_user_id in (None, fake_user_id):
+            result = await db_service.supabase.rpc('explain_match_queries', {
+                'query_embedding': normalize_embedding(prompt_embedding),
+                'match_count': 3,
+                'filter_user_id': filter_user_id
+            }).execute()
+            plan = "\n".join(result.data)
 
-        print(f"✅ Found {len(similar)} similar queries")
+            assert "Index Scan using queries_prompt_embedding_hnsw" in plan, plan
+            logger.debug("✅ Similarity search plan (user filter %s):\n%s", filter_user_id, plan)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+"""Simple pytest tests that uv.lock matches the dependencies in pyproject.toml."""
+
+import re
+from pathlib import Path
+import pytest
+
+tomllib = pytest.importorskip("tomllib")
+
+API_DIR = Path(__file__).resolve().parent.parent
+
+
+def _requirement(spec: str):
+    """Split a PEP 508 requirement into (normalized name, sorted extras, specifier)."""
+    name, extras, specifier = re.match(r"\s*([A-Za-z0-9._-]+)\s*(?:\[([^\]]*)\])?\s*(.*)", spec).groups()
+    extras = tuple(sorted(extra.strip() for extra in extras.split(","))) if extras else ()
+    return re.sub(r"[-_.]+", "-", name).lower(), extras, specifier.replace(" ", "")
+
+
+def _locked(entry: dict):
+    """The same tuple for a requirement recorded in uv.lock."""
+    return entry["name"], tuple(sorted(entry.get("extras", []))), entry.get("specifier", "")
+
+
+class TestDependencies:
+    """Simple test suite for the lock file."""
+
+    @pytest.fixture
+    def project(self):
+        """The project table of pyproject.toml and the lock entry for it."""
+        pyproject = tomllib.loads((API_DIR / "pyproject.toml").read_text())
+        lock = tomllib.loads((API_DIR / "uv.lock").read_text())
+        name = pyproject["project"]["name"]
+        package = next(package for package in lock["package"] if package["name"] == name)
+        return pyproject, package["metadata"]
+
+    def test_lock_covers_project_dependencies(self, project):
+        """Test that every runtime and extra dependency was locked, so `uv sync` installs it."""
+        pyproject, metadata = project
+        locked = {_locked(entry) for entry in metadata["requires-dist"]}
+
+        declared = list(pyproject["project"]["dependencies"])
+        for specs in pyproject["project"].get("optional-dependencies", {}).values():
+            declared.extend(specs)
+
+        missing = [spec for spec in declared if _requirement(spec) not in locked]
+        assert not missing, f"uv.lock is stale, run `uv lock`: {missing}"
+
+    def test_lock_covers_dependency_groups(self, project):
+        """Test that every dependency group requirement was locked."""
+        pyproject, metadata = project
+        locked_groups = metadata.get("requires-dev", {})
+
+        for group, specs in pyproject.get("dependency-groups", {}).items():
+            locked = {_locked(entry) for entry in locked_groups.get(group, [])}
+            missing = [spec for spec in specs if _requirement(spec) not in locked]
+            assert not missing, f"uv.lock is stale, run `uv lock`: {missing}"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
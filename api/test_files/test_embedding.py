@@ -1,13 +1,34 @@
 """Simple pytest tests for the embedding service."""
 
 import pytest
+import logging
+import asyncio
 import os
+from types import SimpleNamespace
 from dotenv import load_dotenv
-from embedding_service import get_embedding_service
+from embedding_service import EmbeddingService, get_embedding_service, get_openai_http_client
 
 # Load environment variables
 load_dotenv()
 
+# Credentials for the integration tests, read once at import
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+logger = logging.getLogger(__name__)
+
+
+class FakeEmbeddings:
+    """Stand-in for the OpenAI embeddings resource that records each request."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def create(self, model, input, dimensions, **kwargs):
+        self.calls.append(list(input))
+        data = [SimpleNamespace(index=i, embedding=[float(len(text))]) for i, text in enumerate(input)]
+        # Return out of order to make sure callers sort by index
+        return SimpleNamespace(data=list(reversed(data)))
+
 
 class TestEmbeddingService:
     """Simple test suite for the embedding service."""
@@ -22,16 +43,16 @@ class TestEmbeddingService:
         service = get_embedding_service()
         assert service is not None
         assert service.model == "text-embedding-3-small"
-        assert service.dimensions == 1536
-        print("✅ Embedding service created successfully")
+        assert service.dimensions == 512
+        logger.debug("✅ Embedding service created successfully")
 
-    @pytest.mark.skipif(not os.getenv("OPENAI_API_KEY"), reason="OPENAI_API_KEY not set")
+    @pytest.mark.skipif(not OPENAI_API_KEY, reason="OPENAI_API_KEY not set")
     @pytest.mark.asyncio
     async def test_generate_embedding_basic(self, embedding_service):
         """Test basic embedding generation with real API."""
         test_text = "What is machine learning?"
 
-        print(f"Generating embedding for: '{test_text}'")
+        logger.debug("Generating embedding for: '%s'", test_text)
 
         # Generate embedding using real OpenAI API
         embedding = await embedding_service.generate_embedding(test_text)
@@ -39,13 +60,13 @@ class TestEmbeddingService:
         # Verify results
         assert embedding is not None
         assert isinstance(embedding, list)
-        assert len(embedding) == 1536
+        assert len(embedding) == 512
         assert all(isinstance(x, (int, float)) for x in embedding)
 
-        print(f"✅ Success! Generated embedding with {len(embedding)} dimensions")
-        print(f"First 5 values: {embedding[:5]}")
+        logger.debug("✅ Success! Generated embedding with %d dimensions", len(embedding))
+        logger.debug("First 5 values: %s", embedding[:5])
 
-    @pytest.mark.skipif(not os.getenv("OPENAI_API_KEY"), reason="OPENAI_API_KEY not set")
+    @pytest.mark.skipif(not OPENAI_API_KEY, reason="OPENAI_API_KEY not set")
     @pytest.mark.asyncio
     async def test_different_texts_different_embeddings(self, embedding_service):
         """Test that different texts produce different embeddings."""
@@ -58,10 +79,132 @@ class TestEmbeddingService:
 
         # Verify they are different
         assert embedding1 != embedding2
-        assert len(embedding1) == 1536
-        assert len(embedding2) == 1536
+        assert len(embedding1) == 512
+        assert len(embedding2) == 512
+
+        logger.debug("✅ Different texts produce different embeddings")
+
+    @pytest.fixture
+    def fake_service(self, monkeypatch):
+        """Embedding service whose OpenAI client is replaced with FakeEmbeddings."""
+        monkeypatch.setenv("OPENAI_API_KEY", OPENAI_API_KEY or "test-key")
+        service = EmbeddingService()
+        service.client = SimpleNamespace(embeddings=FakeEmbeddings())
+        return service
+
+    @pytest.mark.asyncio
+    async def test_openai_http_pool_is_shared(self):
+        """Test that OpenAI clients share one pool and a closed pool is rebuilt."""
+        pool = get_openai_http_client()
+        assert get_openai_http_client() is pool
+
+        await pool.aclose()
+        assert get_openai_http_client() is not pool
+
+    @pytest.mark.asyncio
+    async def test_generate_embeddings_batches_in_order(self, fake_service):
+        """Test that batch embedding chunks requests and keeps input order."""
+        texts = ["a", "bb", "ccc", "dddd", "eeeee"]
+
+        embeddings = await fake_service.generate_embeddings(texts, batch_size=2)
+
+        assert embeddings == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+        assert fake_service.client.embeddings.calls == [["a", "bb"], ["ccc", "dddd"], ["eeeee"]]
+
+    @pytest.mark.asyncio
+    async def test_concurrent_embeddings_are_coalesced(self, fake_service):
+        """Test that concurrent single-text calls share one API request."""
+        texts = ["one", "three", "seventeen"]
+
+        embeddings = await asyncio.gather(*(fake_service.generate_embedding(t) for t in texts))
+
+        assert embeddings == [[3.0], [5.0], [9.0]]
+        assert fake_service.client.embeddings.calls == [texts]
+
+    @pytest.mark.asyncio
+    async def test_repeated_text_is_cached(self, fake_service):
+        """Test that identical texts, concurrent or repeated, hit the API once."""
+        first, second = await asyncio.gather(
+            fake_service.generate_embedding("same text"),
+            fake_service.generate_embedding("same text"),
+        )
+        third = await fake_service.generate_embedding("same text")
+
+        assert first == second == third == [9.0]
+        assert fake_service.client.embeddings.calls == [["same text"]]
+
+    @pytest.mark.asyncio
+    async def test_confident_local_keywords_skip_claude(self, fake_service):
+        """Test that YAKE handles short, keyword-rich text without calling Claude."""
+        async def fail_claude(*args, **kwargs):
+            raise AssertionError("Claude should not be called")
+
+        fake_service.claude_client = SimpleNamespace(messages=SimpleNamespace(create=fail_claude))
+
+        keywords = await fake_service.extract_keywords(
+            "What is machine learning and how does gradient descent work in neural networks?"
+        )
+
+        assert 1 <= len(keywords) <= 3
+        assert "neural networks" in keywords
+
+    @pytest.mark.asyncio
+    async def test_keyword_embedding_falls_back_to_full_text(self, fake_service):
+        """Test that the speculative full-text embedding is used when no keywords come back."""
+        async def no_keywords(text, max_keywords=3):
+            return []
+
+        fake_service.extract_keywords = no_keywords
+
+        embedding, keywords = await fake_service.generate_keyword_embedding("full text")
+
+        assert keywords == []
+        assert embedding == [9.0]
+        assert fake_service.client.embeddings.calls == [["full text"]]
+
+    @pytest.mark.asyncio
+    async def test_shared_full_text_embedding_survives_cancelled_speculation(self, fake_service):
+        """Test that a request sharing the speculative full-text embedding isn't cancelled when keywords win."""
+        async def keywords_found(text, max_keywords=3):
+            return ["kw"]
+
+        fake_service.extract_keywords = keywords_found
+
+        (embedding, keywords), shared = await asyncio.gather(
+            fake_service.generate_keyword_embedding("full text"),
+            fake_service.generate_embedding("full text"),
+        )
+
+        assert keywords == ["kw"]
+        assert embedding == [2.0]
+        assert shared == [9.0]
+
+    @pytest.mark.asyncio
+    async def test_unused_speculation_is_not_sent(self, fake_service):
+        """Test that the full-text embedding is dropped from the batch queue when keywords win."""
+        async def keywords_found(text, max_keywords=3):
+            return ["kw"]
+
+        fake_service.extract_keywords = keywords_found
+
+        embedding, keywords = await fake_service.generate_keyword_embedding("full text")
+
+        assert embedding == [2.0]
+        assert fake_service.client.embeddings.calls == [["kw"]]
+
+    @pytest.mark.asyncio
+    async def test_long_text_is_truncated_and_not_speculated(self, fake_service):
+        """Test that texts over the per-input limit are embedded only on fallback, and truncated."""
+        async def no_keywords(text, max_keywords=3):
+            return []
+
+        fake_service.extract_keywords = no_keywords
+        text = "x" * 100_000
+
+        embedding, keywords = await fake_service.generate_keyword_embedding(text)
 
-        print("✅ Different texts produce different embeddings")
+        assert embedding == [8000.0]
+        assert fake_service.client.embeddings.calls == [["x" * 8000]]
 
 
 if __name__ == "__main__":
@@ -3,6 +3,7 @@ import OpenAI from 'openai';
 interface EmbeddingConfig {
   apiKey: string;
   model: string;
+  dimensions: number;
   timeout: number;
 }
 
@@ -19,6 +20,8 @@ class EmbeddingService {
     this.config = {
       apiKey: config.apiKey || process.env.NEXT_PUBLIC_OPENAI_API_KEY || '',
       model: 'text-embedding-3-small',
+      // Must match the API's EmbeddingService and the queries.*_embedding columns
+      dimensions: 512,
       timeout: config.timeout || 30000,
     };
 
@@ -44,6 +47,7 @@ class EmbeddingService {
       const response = await this.client.embeddings.create({
         model: this.config.model,
         input: cleanText,
+        dimensions: this.config.dimensions,
         encoding_format: 'float'
       });
 
@@ -70,6 +74,7 @@ class EmbeddingService {
     const resp = await this.client.embeddings.create({
       model: this.config.model,
       input: clean,
+      dimensions: this.config.dimensions,
       encoding_format: 'float'
     });
     if (!resp.data || resp.data.length !== clean.length) {
@@ -79,7 +84,7 @@ class EmbeddingService {
   }
 
   getEmbeddingDimensions(): number {
-    return 1536;
+    return this.config.dimensions;
   }
 
   private cleanText(text: string): string {